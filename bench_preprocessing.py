@@ -0,0 +1,114 @@
+"""
+Micro-benchmark for the echogram rendering in the preprocessing stage.
+
+Renders one synthetic channel with the original xarray chain (dropna, log
+transform, bottom crop, matplotlib Normalize) and with the vectorized engine
+in preprocessing/echogram.py, checks that both produce the same masks and
+images (up to one grey level on level boundaries), and reports wall time and
+peak traced allocations for each.
+
+Usage:
+    python bench_preprocessing.py [--pings 20000] [--depths 2000] [--repeat 3]
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / "preprocessing"))
+os.environ.setdefault("LOG_DIR", "/tmp")
+
+from matplotlib.colors import Normalize  # noqa: E402
+
+import echogram  # noqa: E402
+
+
+def synthetic_channel(n_pings, n_depths, seed=0):
+    """Linear Sv with a NaN-padded tail and a bottom around two thirds depth."""
+    rng = np.random.default_rng(seed)
+    depth = np.linspace(0, 500, n_depths)
+    ping_time = np.datetime64("2024-01-01", "ns") + np.arange(n_pings).astype(
+        "timedelta64[s]"
+    )
+    sv = 10 ** (rng.uniform(-90, -20, size=(n_pings, n_depths)) / 10)
+    sv[:, -n_depths // 20 :] = np.nan
+    bottom = rng.uniform(280, 340, size=n_pings)
+    bottom[:: max(n_pings // 50, 1)] = np.nan
+
+    coords = {"ping_time": ping_time, "depth": depth}
+    sv = xr.DataArray(sv, coords=coords, dims=["ping_time", "depth"])
+    bottom = xr.DataArray(bottom, coords={"ping_time": ping_time}, dims=["ping_time"])
+    return sv, bottom
+
+
+def render_xarray(sv, bottom, vmin=-80, vmax=-30, offset=3):
+    """The chain sv_to_jpg ran before the vectorized engine, with Normalize."""
+    sv = 10 * np.log10(sv.dropna(dim="depth"))
+    bottom = bottom.dropna(dim="ping_time")
+    sv = sv.where(sv.depth <= bottom + offset, drop=True)
+    sv = sv.where(sv.depth >= 25, drop=True)
+    mask = (sv.depth <= bottom + offset) & (sv.depth >= 25)
+    norm = Normalize(vmin=vmin, vmax=vmax, clip=True)
+    image = (norm(np.array(sv.data)) * 255).T.astype(np.uint8)
+    return image, np.asarray(mask)
+
+
+def render_engine(sv, bottom, vmin=-80, vmax=-30):
+    return echogram.render(sv, sv.depth.values, bottom.values, vmin, vmax)
+
+
+def measure(fn, *args, repeat=3):
+    """Best wall time over `repeat` runs and the peak traced allocation of one."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--pings", type=int, default=20000)
+    parser.add_argument("--depths", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    sv, bottom = synthetic_channel(args.pings, args.depths)
+    print(
+        f"Channel: {args.pings} pings x {args.depths} depths, {sv.nbytes / 2**20:.0f} MiB"
+    )
+
+    with np.errstate(invalid="ignore"):
+        (ref_image, ref_mask), ref_time, ref_peak = measure(
+            render_xarray, sv, bottom, repeat=args.repeat
+        )
+    (image, mask), time_, peak = measure(render_engine, sv, bottom, repeat=args.repeat)
+
+    # The fused affine map may put a value on a level boundary one level lower
+    diff = np.abs(image.astype(int) - ref_image)
+    assert diff.max() <= 1, "images differ by more than one grey level"
+    assert np.array_equal(mask, ref_mask), "masks differ"
+
+    print(f"{'':10}{'time (s)':>10}{'peak alloc (MiB)':>18}")
+    print(f"{'xarray':10}{ref_time:>10.3f}{ref_peak / 2**20:>18.1f}")
+    print(f"{'engine':10}{time_:>10.3f}{peak / 2**20:>18.1f}")
+    print(
+        f"Speedup {ref_time / time_:.1f}x, {ref_peak / max(peak, 1):.1f}x less memory, "
+        f"{(diff != 0).mean():.4%} of pixels one level apart"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,9 @@
 # %%
 from pathlib import Path
 import os
+import json
 import logging
 
-
 input_dir = os.getenv("INPUT_DIR", "/data/test_imgs")
 output_dir = os.getenv("OUTPUT_DIR", "/data/inference")
 log = os.getenv("LOG_DIR", ".")
@@ -45,13 +45,30 @@ DEVICE = torch.device(
     os.getenv("DEVICE", "cuda" if torch.cuda.is_available() else "cpu")
 )
 BATCH_SIZE = int(os.getenv("BATCH_SIZE", 4))
+# Tiled inference: overlapping TILE_SIZE x TILE_SIZE tiles at native resolution
+# instead of resizing to DOWNSAMPLE_SIZE (0 = off); must be a multiple of PATCH_SZ
+TILE_SIZE = int(os.getenv("TILE_SIZE", 0))
+TILE_OVERLAP = int(os.getenv("TILE_OVERLAP", 128))
+# Aspect-preserving batching: images are fit into DOWNSAMPLE_SIZE with their
+# sides rounded to multiples of BUCKET_STEP px and batched per resulting size
+# (0 = every image resized to a DOWNSAMPLE_SIZE square)
+BUCKET_STEP = int(os.getenv("BUCKET_STEP", 0))
+# Queries per attention chunk (0 = unchunked); bounds memory at large DOWNSAMPLE_SIZE
+ATTN_CHUNK = int(os.getenv("ATTN_CHUNK", 0))
+
+# Name of the multi-frequency RGB echogram written with COMPOSITE_FREQS
+COMPOSITE = "composite"
 
 
 def setup_device_and_model(
     arch="vit_tiny", patch_size=16, pretrained_weights=None, checkpoint_key="teacher"
 ):
     device = DEVICE
-    model = vits.__dict__[arch](patch_size=patch_size, num_classes=0).eval().to(device)
+    model = (
+        vits.__dict__[arch](patch_size=patch_size, num_classes=0, attn_chunk=ATTN_CHUNK)
+        .eval()
+        .to(device)
+    )
     for p in model.parameters():
         p.requires_grad = False
 
@@ -75,7 +92,9 @@ def setup_device_and_model(
                 raise ValueError(f"Invalid patch size: {patch_size}")
 
             model = (
-                vits.__dict__["vit_small"](patch_size=patch_size, num_classes=0)
+                vits.__dict__["vit_small"](
+                    patch_size=patch_size, num_classes=0, attn_chunk=ATTN_CHUNK
+                )
                 .eval()
                 .to(device)
             )
@@ -90,6 +109,10 @@ def setup_device_and_model(
     return device, model
 
 
+# ImageNet statistics the DINO weights were trained with
+MEAN, STD = (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)
+
+
 def process_image(image_path, image_size=(1000, 1000)):
     img = Image.open(image_path).convert("RGB")
 
@@ -97,15 +120,89 @@ def process_image(image_path, image_size=(1000, 1000)):
         [
             pth_transforms.Resize(image_size),
             pth_transforms.ToTensor(),
-            pth_transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+            pth_transforms.Normalize(MEAN, STD),
         ]
     )
     return transform(img)
 
 
-def get_attention_maps(model, img_tensor, image_size, patch_size):
-    """Extract attention maps. img_tensor can be (1,C,H,W) or (B,C,H,W)."""
-    raw_attn = model.get_last_selfattention(img_tensor)
+def read_shard(folder: Path):
+    """
+    Memory-mapped tensors and entry names of a tensor shard written by the
+    preprocessing stage (tensors.npy + index.json), or None for PNG samples.
+    The map is copy-on-write, so torch can wrap it without a copy.
+    """
+    index_file = folder / "index.json"
+    if not index_file.exists():
+        return None
+    index = json.loads(index_file.read_text())
+    tensors = np.load(folder / "tensors.npy", mmap_mode="c")
+    return tensors, [entry["name"] for entry in index["entries"]]
+
+
+def gather(sources):
+    """
+    (B, H, W, C) uint8 array of shard entries ((tensors, index) pairs): a
+    slice of the memory-mapped shard when they are consecutive entries of
+    one shard, so nothing is copied on the host, otherwise a stacked copy.
+    """
+    tensors, first = sources[0]
+    if all(t is tensors and i == first + k for k, (t, i) in enumerate(sources)):
+        return tensors[first : first + len(sources)]
+    return np.stack([t[i] for t, i in sources])
+
+
+def shard_batch(array, image_size, device):
+    """
+    Normalized (B, 3, H, W) batch from a (B, H, W, C) uint8 array of shard
+    entries. The uint8 data is moved to `device` first and converted there;
+    entries are only resized when they were written for another resolution.
+    """
+    x = torch.from_numpy(array).to(device)
+    x = x.permute(0, 3, 1, 2).float().div(255)
+    if x.shape[1] == 1:
+        x = x.expand(-1, 3, -1, -1)
+    if tuple(x.shape[-2:]) != tuple(image_size):
+        x = nn.functional.interpolate(
+            x, size=image_size, mode="bilinear", antialias=True, align_corners=False
+        )
+    return pth_transforms.functional.normalize(x, MEAN, STD)
+
+
+def load_batch(sources, image_size, device):
+    """Batch PNG paths and shard entries ((tensors, index) pairs) alike."""
+    if all(isinstance(s, tuple) for s in sources):
+        return shard_batch(gather(sources), image_size, device)
+    cpu = torch.device("cpu")
+    return torch.stack(
+        [
+            (
+                shard_batch(gather([s]), image_size, cpu)[0]
+                if isinstance(s, tuple)
+                else process_image(s, image_size)
+            )
+            for s in sources
+        ]
+    ).to(device)
+
+
+def preview(source):
+    """PIL image of a PNG path or shard entry, for visualize_attention."""
+    if isinstance(source, tuple):
+        tensors, i = source
+        array = tensors[i]
+        return Image.fromarray(array[..., 0] if array.shape[-1] == 1 else array)
+    return Image.open(source)
+
+
+def get_attention_maps(model, img_tensor, image_size, patch_size, normalize=True):
+    """
+    Extract attention maps. img_tensor can be (1,C,H,W) or (B,C,H,W). Each map
+    is scaled to 0..1 unless `normalize` is False, which returns the raw
+    [CLS] attention.
+    """
+    # Only the [CLS] row is used, so the last block never builds N x N attention
+    raw_attn = model.get_last_cls_attention(img_tensor)
     B = raw_attn.shape[0]
     results = []
     for b in range(B):
@@ -122,13 +219,135 @@ def get_attention_maps(model, img_tensor, image_size, patch_size):
             .cpu()
             .numpy()
         )
-        attn = (attn - attn.min()) / (attn.max() - attn.min())
+        if normalize:
+            attn = (attn - attn.min()) / (attn.max() - attn.min())
         results.append(attn)
     if B == 1:
         return results[0]
     return results
 
 
+def load_native(source):
+    """Normalized (3, H, W) CPU tensor of a PNG path or shard entry, not resized."""
+    if isinstance(source, tuple):
+        tensors, i = source
+        array = gather([source])
+        return shard_batch(array, tensors.shape[1:3], torch.device("cpu"))[0]
+    img = Image.open(source).convert("RGB")
+    return pth_transforms.functional.normalize(
+        pth_transforms.functional.to_tensor(img), MEAN, STD
+    )
+
+
+def tile_starts(length, tile, overlap):
+    """Offsets of tiles covering `length`, the last one flush with the end."""
+    if length <= tile:
+        return [0]
+    step = max(tile - overlap, 1)
+    starts = list(range(0, length - tile, step))
+    return starts + [length - tile]
+
+
+def blend_weights(tile, overlap):
+    """tile x tile weights ramping up over `overlap` pixels from every edge."""
+    ramp = (np.arange(tile) + 0.5) / max(overlap, 1)
+    ramp = np.minimum(np.minimum(ramp, ramp[::-1]), 1.0)
+    return np.outer(ramp, ramp).astype(np.float32)
+
+
+def tiled_attention(model, img_tensor, tile, overlap, patch_size, device):
+    """
+    Attention maps (heads, H, W) of a (3, H, W) image at native resolution:
+    overlapping tile x tile crops go through get_attention_maps in batches of
+    BATCH_SIZE and their raw [CLS] attention is blended with weights that
+    fade out towards the tile edges, then scaled to 0..1 once, so tiles stay
+    comparable. Images smaller than a tile are padded with the mean.
+    """
+    if tile % patch_size:
+        raise ValueError(
+            f"TILE_SIZE {tile} is not a multiple of patch size {patch_size}"
+        )
+    _, H, W = img_tensor.shape
+    pad_h, pad_w = max(tile - H, 0), max(tile - W, 0)
+    if pad_h or pad_w:
+        img_tensor = nn.functional.pad(img_tensor, (0, pad_w, 0, pad_h))
+    _, h, w = img_tensor.shape
+
+    boxes = [
+        (y, x)
+        for y in tile_starts(h, tile, overlap)
+        for x in tile_starts(w, tile, overlap)
+    ]
+    weights = blend_weights(tile, overlap)
+    total = np.zeros((h, w), dtype=np.float32)
+    blended = None
+
+    for i in range(0, len(boxes), BATCH_SIZE):
+        batch = boxes[i : i + BATCH_SIZE]
+        tiles = torch.stack(
+            [img_tensor[:, y : y + tile, x : x + tile] for y, x in batch]
+        ).to(device)
+        with torch.no_grad():
+            maps = get_attention_maps(
+                model,
+                tiles,
+                image_size=(tile, tile),
+                patch_size=patch_size,
+                normalize=False,
+            )
+        if len(batch) == 1:
+            maps = [maps]
+
+        for (y, x), attn in zip(batch, maps):
+            if blended is None:
+                blended = np.zeros((attn.shape[0], h, w), dtype=np.float32)
+            blended[:, y : y + tile, x : x + tile] += attn * weights
+            total[y : y + tile, x : x + tile] += weights
+
+    blended = blended[:, :H, :W] / total[:H, :W]
+    return (blended - blended.min()) / (blended.max() - blended.min())
+
+
+def source_size(source):
+    """(height, width) of a PNG path or shard entry, without decoding pixels."""
+    if isinstance(source, tuple):
+        tensors, _ = source
+        return tuple(tensors.shape[1:3])
+    with Image.open(source) as img:
+        return img.height, img.width
+
+
+def bucket_size(height, width, size, patch_size, step):
+    """
+    Input size of a height x width image: scaled to fit `size` x `size` with
+    its aspect ratio kept, each side rounded to a multiple of `step` (itself
+    rounded up to the patch size) so similar images share a bucket.
+    """
+    step = -(-step // patch_size) * patch_size
+    scale = size / max(height, width)
+    return tuple(
+        min(max(round(side * scale / step), 1) * step, -(-size // step) * step)
+        for side in (height, width)
+    )
+
+
+def plan_batches(items, size, patch_size, step, source=lambda item: item):
+    """
+    Group `items` by bucket_size of their image and split every bucket into
+    batches of BATCH_SIZE: [(image_size, items), ...]. All images of a batch
+    share one token grid, and so one positional encoding interpolation.
+    """
+    buckets = {}
+    for item in items:
+        key = bucket_size(*source_size(source(item)), size, patch_size, step)
+        buckets.setdefault(key, []).append(item)
+    return [
+        (key, bucket[i : i + BATCH_SIZE])
+        for key, bucket in buckets.items()
+        for i in range(0, len(bucket), BATCH_SIZE)
+    ]
+
+
 def visualize_attention(img, attentions, nh, image_size):
     fig, axes = plt.subplots(nh + 1, 1, figsize=(15, 15))
     # Resize the image and convert to numpy array
@@ -151,7 +370,7 @@ def assert_img_sizes(file, image_size):
     img = Image.open(file)
     array = np.array(img)
 
-    w, h = array.shape
+    w, h = array.shape[:2]  # Greyscale or colormapped RGB
     downsample_w, downsample_h = image_size
     if w > downsample_w:
         w = downsample_w
@@ -182,14 +401,21 @@ def reduce_files_to_diff(inp: Path, out: Path):
     * We treat each first-level folder (stem) in *inp* as one logical sample.
     * A folder counts as *already processed* if a corresponding folder
       exists in *out* **and** contains at least one PNG file.
+    * Hidden folders (such as the ``.tmp`` staging area) are skipped.
     """
-    in_stems = {p.stem for p in inp.glob("*") if p.is_dir()}
+    in_stems = {
+        p.stem for p in inp.glob("*") if p.is_dir() and not p.name.startswith(".")
+    }
     processed_stems = {
         p.stem for p in out.glob("*") if p.is_dir() and any(p.glob("*.png"))
     }
 
     pending_stems = in_stems - processed_stems
-    return [p for p in inp.glob("*") if p.stem in pending_stems]
+    return [
+        p
+        for p in inp.glob("*")
+        if p.stem in pending_stems and not p.name.startswith(".")
+    ]
 
 
 patch_size = int(os.getenv("PATCH_SZ", 8))
@@ -197,6 +423,25 @@ arch = os.getenv("ARCH", "vit_small")
 size = int(os.getenv("DOWNSAMPLE_SIZE", 5000))
 
 
+def sample_inputs(folder: Path, base_out: Path):
+    """
+    (source, output path) pairs of one sample folder: shard entries or PNGs,
+    only the RGB composite when there is one, as it covers every frequency.
+    """
+    shard = read_shard(folder)
+    if shard is not None:
+        tensors, names = shard
+        entries = list(enumerate(names))
+        if COMPOSITE in names:
+            entries = [(names.index(COMPOSITE), COMPOSITE)]
+        return [((tensors, i), base_out / f"{name}.png") for i, name in entries]
+
+    files = sorted(folder.glob("*.png"))
+    if folder / f"{COMPOSITE}.png" in files:
+        files = [folder / f"{COMPOSITE}.png"]
+    return [(file, base_out / file.name) for file in files]
+
+
 @log_errors
 def consume_dir(input_dir: Path, output_dir: Path):
     device, model = setup_device_and_model(
@@ -209,23 +454,48 @@ def consume_dir(input_dir: Path, output_dir: Path):
     for folder in files_to_compute:
         base_out = output_dir / folder.name
         base_out.mkdir(parents=True, exist_ok=True)
-        for file in folder.glob("*.png"):
-            all_files.append((file, base_out / file.name))
+        all_files.extend(sample_inputs(folder, base_out))
 
     if not all_files:
         logging.warning("No files to process")
         return
 
-    image_size = (size, size)
+    if TILE_SIZE:
+        logging.info(
+            f"Processing {len(all_files)} images in {TILE_SIZE} px tiles "
+            f"in batches of {BATCH_SIZE} on {DEVICE}"
+        )
+        for file, out_path in all_files:
+            attentions = tiled_attention(
+                model, load_native(file), TILE_SIZE, TILE_OVERLAP, patch_size, device
+            )
+            visualize_attention(
+                preview(file),
+                attentions,
+                attentions.shape[0],
+                image_size=attentions.shape[1:],
+            )
+            plt.savefig(out_path)
+            plt.close()
+        logging.info(f"Finished processing {len(all_files)} images")
+        return
+
+    if BUCKET_STEP:
+        batches = plan_batches(
+            all_files, size, patch_size, BUCKET_STEP, source=lambda f: f[0]
+        )
+    else:
+        batches = [
+            ((size, size), all_files[i : i + BATCH_SIZE])
+            for i in range(0, len(all_files), BATCH_SIZE)
+        ]
     logging.info(
-        f"Processing {len(all_files)} images in batches of {BATCH_SIZE} on {DEVICE}"
+        f"Processing {len(all_files)} images as {len(batches)} batches of up to "
+        f"{BATCH_SIZE} in {len({s for s, _ in batches})} sizes on {DEVICE}"
     )
 
-    for i in range(0, len(all_files), BATCH_SIZE):
-        batch = all_files[i : i + BATCH_SIZE]
-        tensors = torch.stack([process_image(f, image_size) for f, _ in batch]).to(
-            device
-        )
+    for image_size, batch in batches:
+        tensors = load_batch([f for f, _ in batch], image_size, device)
 
         try:
             with torch.no_grad():
@@ -234,8 +504,8 @@ def consume_dir(input_dir: Path, output_dir: Path):
                 )
         except torch.cuda.OutOfMemoryError:
             logging.warning("CUDA OOM — falling back to CPU for this batch")
+            model.cpu()  # Also drops the model's cached GPU positional encodings
             torch.cuda.empty_cache()
-            model.cpu()
             device = torch.device("cpu")
             tensors = tensors.cpu()
             with torch.no_grad():
@@ -249,7 +519,7 @@ def consume_dir(input_dir: Path, output_dir: Path):
 
         for (file, out_path), attentions in zip(batch, attn_maps):
             visualize_attention(
-                Image.open(file), attentions, attentions.shape[0], image_size=image_size
+                preview(file), attentions, attentions.shape[0], image_size=image_size
             )
             plt.savefig(out_path)
             plt.close()
@@ -16,10 +16,12 @@ Mostly copy-paste from timm library.
 https://github.com/rwightman/pytorch-image-models/blob/master/timm/models/vision_transformer.py
 """
 import math
+from collections import OrderedDict
 from functools import partial
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from utils import trunc_normal_
 
@@ -66,11 +68,13 @@ class Mlp(nn.Module):
 
 
 class Attention(nn.Module):
-    def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0.):
+    def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0., attn_chunk=0):
         super().__init__()
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = qk_scale or head_dim ** -0.5
+        # queries per chunk in forward_fused, 0 for all at once
+        self.attn_chunk = attn_chunk
 
         self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
         self.attn_drop = nn.Dropout(attn_drop)
@@ -91,23 +95,58 @@ class Attention(nn.Module):
         x = self.proj_drop(x)
         return x, attn
 
+    def forward_fused(self, x):
+        """Same output as forward, without materializing the N x N attention."""
+        B, N, C = x.shape
+        qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+
+        dropout_p = self.attn_drop.p if self.training else 0.
+        if self.attn_chunk and N > self.attn_chunk:
+            # every query row is softmaxed over all keys, so chunks are exact;
+            # scores are at most B x heads x attn_chunk x N at a time
+            x = torch.empty_like(q)
+            for start in range(0, N, self.attn_chunk):
+                stop = start + self.attn_chunk
+                x[:, :, start:stop] = F.scaled_dot_product_attention(
+                    q[:, :, start:stop], k, v, dropout_p=dropout_p, scale=self.scale)
+        else:
+            x = F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p, scale=self.scale)
+        x = x.transpose(1, 2).reshape(B, N, C)
+        x = self.proj(x)
+        x = self.proj_drop(x)
+        return x
+
+    def cls_attention(self, x):
+        """Attention of the [CLS] query only: (B, heads, 1, N), the first row of forward's attn."""
+        B, N, C = x.shape
+        w_q, w_k = self.qkv.weight[:C], self.qkv.weight[C:2 * C]
+        b_q, b_k = (None, None) if self.qkv.bias is None else (self.qkv.bias[:C], self.qkv.bias[C:2 * C])
+        q = F.linear(x[:, :1], w_q, b_q).reshape(B, 1, self.num_heads, C // self.num_heads).transpose(1, 2)
+        k = F.linear(x, w_k, b_k).reshape(B, N, self.num_heads, C // self.num_heads).transpose(1, 2)
+
+        attn = (q @ k.transpose(-2, -1)) * self.scale
+        return attn.softmax(dim=-1)
+
 
 class Block(nn.Module):
     def __init__(self, dim, num_heads, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop=0., attn_drop=0.,
-                 drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm):
+                 drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm, attn_chunk=0):
         super().__init__()
         self.norm1 = norm_layer(dim)
         self.attn = Attention(
-            dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop)
+            dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop,
+            attn_chunk=attn_chunk)
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
         self.norm2 = norm_layer(dim)
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
 
     def forward(self, x, return_attention=False):
-        y, attn = self.attn(self.norm1(x))
         if return_attention:
+            _, attn = self.attn(self.norm1(x))
             return attn
+        y = self.attn.forward_fused(self.norm1(x))
         x = x + self.drop_path(y)
         x = x + self.drop_path(self.mlp(self.norm2(x)))
         return x
@@ -132,10 +171,14 @@ class PatchEmbed(nn.Module):
 
 
 class VisionTransformer(nn.Module):
-    """ Vision Transformer """
+    """ Vision Transformer
+
+    attn_chunk > 0 computes attention for that many queries at a time, so peak
+    memory grows linearly with the number of tokens instead of quadratically.
+    """
     def __init__(self, img_size=[224], patch_size=16, in_chans=3, num_classes=0, embed_dim=768, depth=12,
                  num_heads=12, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop_rate=0., attn_drop_rate=0.,
-                 drop_path_rate=0., norm_layer=nn.LayerNorm, **kwargs):
+                 drop_path_rate=0., norm_layer=nn.LayerNorm, attn_chunk=0, **kwargs):
         super().__init__()
         self.num_features = self.embed_dim = embed_dim
 
@@ -151,9 +194,11 @@ class VisionTransformer(nn.Module):
         self.blocks = nn.ModuleList([
             Block(
                 dim=embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
-                drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer)
+                drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer,
+                attn_chunk=attn_chunk)
             for i in range(depth)])
         self.norm = norm_layer(embed_dim)
+        self.clear_pos_cache()
 
         # Classifier head
         self.head = nn.Linear(embed_dim, num_classes) if num_classes > 0 else nn.Identity()
@@ -171,11 +216,47 @@ class VisionTransformer(nn.Module):
             nn.init.constant_(m.bias, 0)
             nn.init.constant_(m.weight, 1.0)
 
+    # bytes of interpolated positional encodings kept per input geometry, least recently used
+    # evicted first; the latest entry is always kept (at 5000 px and patch 8 one is ~600 MB)
+    pos_cache_bytes = 256 * 2 ** 20
+
+    def clear_pos_cache(self):
+        self._pos_cache = OrderedDict()
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        # new weights invalidate every interpolated encoding
+        self.clear_pos_cache()
+        super()._load_from_state_dict(*args, **kwargs)
+
+    def _apply(self, fn, *args, **kwargs):
+        # .to() / .cpu() / .half(): drop encodings so they don't pin the old device's memory
+        self.clear_pos_cache()
+        return super()._apply(fn, *args, **kwargs)
+
     def interpolate_pos_encoding(self, x, w, h):
         npatch = x.shape[1] - 1
         N = self.pos_embed.shape[1] - 1
         if npatch == N and w == h:
             return self.pos_embed
+        # the cached tensor carries no graph, so only reuse it when no gradient is needed
+        if torch.is_grad_enabled() and self.pos_embed.requires_grad:
+            return self._interpolate_pos_encoding(x, w, h)
+
+        key = (w, h, self.patch_embed.patch_size, self.pos_embed.dtype, self.pos_embed.device,
+               self.pos_embed._version)
+        cache = self._pos_cache
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        pos = cache[key] = self._interpolate_pos_encoding(x, w, h)
+        size = sum(t.numel() * t.element_size() for t in cache.values())
+        while len(cache) > 1 and size > self.pos_cache_bytes:
+            _, old = cache.popitem(last=False)
+            size -= old.numel() * old.element_size()
+        return pos
+
+    def _interpolate_pos_encoding(self, x, w, h):
+        N = self.pos_embed.shape[1] - 1
         class_pos_embed = self.pos_embed[:, 0]
         patch_pos_embed = self.pos_embed[:, 1:]
         dim = x.shape[-1]
@@ -222,6 +303,14 @@ class VisionTransformer(nn.Module):
                 # return attention of the last block
                 return blk(x, return_attention=True)
 
+    def get_last_cls_attention(self, x):
+        """[CLS] row of the last block's attention, (B, heads, 1, N), without the N x N matrix."""
+        x = self.prepare_tokens(x)
+        for blk in self.blocks[:-1]:
+            x = blk(x)
+        last = self.blocks[-1]
+        return last.attn.cls_attention(last.norm1(x))
+
     def get_intermediate_layers(self, x, n=1):
         x = self.prepare_tokens(x)
         # we return the output tokens from the `n` last blocks
@@ -0,0 +1,82 @@
+"""
+Area-averaged downsampling of Sv.
+
+Echograms can hold tens of thousands of depth samples per ping, far more
+than the inference resolution. Averaging blocks of ping_bin x depth_bin
+samples in the linear domain keeps the mean backscatter of every cell, where
+resizing the finished image averages dB grey levels. Blocks are averaged
+with a reshape and a sum; a trailing partial block is averaged over the
+samples it holds, and NaN propagates so the dropna over depth that follows
+still drops padded rows.
+"""
+
+import warnings
+
+import numpy as np
+import xarray as xr
+
+from echogram import BLOCK_PINGS, iter_blocks
+
+
+def bin_counts(n, size):
+    """Number of samples in each of the ceil(n / size) bins of `size`."""
+    counts = np.full(-(-n // size), size)
+    counts[-1] = n - size * (counts.size - 1)
+    return counts
+
+
+def block_mean(a, ping_bin, depth_bin):
+    """Mean of the 2-D `a` over ping_bin x depth_bin blocks."""
+    p, d = a.shape
+    n_p, n_d = -(-p // ping_bin), -(-d // depth_bin)
+    dtype = np.result_type(a.dtype, np.float32)
+
+    if p % ping_bin or d % depth_bin:
+        padded = np.zeros((n_p * ping_bin, n_d * depth_bin), dtype=dtype)
+        padded[:p, :d] = a
+        a = padded
+    sums = a.reshape(n_p, ping_bin, n_d, depth_bin).sum(axis=(1, 3), dtype=dtype)
+    return sums / np.outer(bin_counts(p, ping_bin), bin_counts(d, depth_bin))
+
+
+def downsample(sv, bottom=None, ping_bin=1, depth_bin=1, linear=True):
+    """
+    Average `sv` (ping_time x depth DataArray, possibly lazily loaded) over
+    ping_bin x depth_bin cells in the linear domain, reading one block of
+    pings at a time. dB input is averaged as linear Sv and returned in dB.
+
+    Cells are labelled with their first ping time and mean depth; `bottom`,
+    if given, is averaged per ping bin over the pings where it is known.
+    Returns (sv, bottom) on the coarse grid.
+    """
+    step = max(BLOCK_PINGS // ping_bin, 1) * ping_bin
+    blocks = []
+    for _, _, block in iter_blocks(sv, step):
+        if not linear:
+            block = 10 ** (block / 10)
+        blocks.append(block_mean(block, ping_bin, depth_bin))
+    data = np.concatenate(blocks)
+    if not linear:
+        with np.errstate(divide="ignore"):
+            data = 10 * np.log10(data)
+
+    depth = block_mean(sv.depth.values[None, :], 1, depth_bin)[0]
+    ping_time = sv.ping_time.values[::ping_bin]
+    binned = xr.DataArray(
+        data,
+        coords={"ping_time": ping_time, "depth": depth},
+        dims=["ping_time", "depth"],
+        attrs=sv.attrs,
+    )
+
+    if bottom is not None:
+        values = np.asarray(bottom, dtype=float)
+        padded = np.full(binned.sizes["ping_time"] * ping_bin, np.nan)
+        padded[: values.size] = values
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # Bins without bottom
+            values = np.nanmean(padded.reshape(-1, ping_bin), axis=1)
+        bottom = xr.DataArray(
+            values, coords={"ping_time": ping_time}, dims=["ping_time"]
+        )
+    return binned, bottom
@@ -0,0 +1,115 @@
+"""
+Multi-frequency RGB composites.
+
+Inference converts every greyscale echogram to RGB by repeating the grey
+channel, so each frequency costs a ViT forward pass of which two thirds is
+redundant input. A composite packs three frequencies (COMPOSITE_FREQS, in
+Hz, e.g. 38000,120000,200000) into the R, G and B channels of one image,
+written next to the per-frequency outputs as composite.png and/or as the
+"composite" entry of the tensor shard; inference then runs one pass per
+file instead of one per frequency.
+
+The per-frequency echograms cannot simply be stacked: every channel gets
+its own seafloor crop, NaN depth rows and pings without a bottom are
+dropped per channel, so a pixel row means a different depth in each.
+Instead the three channels are rendered onto one shared grid, before
+quantization: the pings all of them hold (with a bottom, where one is
+given), and the depth range all of them cover, sampled on the first
+channel's depths. The other channels are regridded by depth coordinate,
+nearest sample within half their own spacing, so a dropped row stays a gap.
+"""
+
+from functools import reduce
+
+import numpy as np
+
+from echogram import BLOCK_PINGS, affine, as_slice, quantize
+
+NAME = "composite"
+
+
+def parse_freqs(spec):
+    """Frequencies (Hz) of COMPOSITE_FREQS, or () when unset."""
+    freqs = tuple(int(float(f)) for f in spec.split(",") if f.strip())
+    if freqs and len(freqs) != 3:
+        raise ValueError(f"COMPOSITE_FREQS needs three frequencies, got {spec!r}")
+    return freqs
+
+
+def nearest(src, dst):
+    """
+    Index of the sample of the sorted `src` nearest to every `dst` value, and
+    whether it lies within half the spacing of `src`.
+    """
+    if src.size == 1:
+        return np.zeros(dst.size, dtype=int), dst == src[0]
+    idx = np.clip(np.searchsorted(src, dst), 1, src.size - 1)
+    idx -= dst - src[idx - 1] <= src[idx] - dst
+    tol = 0.5 * np.median(np.diff(src)) * (1 + 1e-6)
+    return idx, np.abs(src[idx] - dst) <= tol
+
+
+def shared_grid(layers, offset=3, min_depth=25):
+    """
+    (ping times, depths) every layer covers, or None when they share no ping
+    or no depth. `layers` are (sv, bottom or None, linear) as for `render`.
+    """
+    times = reduce(np.intersect1d, [sv.ping_time.values for sv, _, _ in layers])
+    lo = max(sv.depth.values[0] for sv, _, _ in layers)
+    hi = min(sv.depth.values[-1] for sv, _, _ in layers)
+
+    for sv, bottom, _ in layers:
+        if bottom is None:
+            continue
+        at = np.asarray(bottom)[np.searchsorted(sv.ping_time.values, times)]
+        times = times[~np.isnan(at)]
+        if times.size == 0:
+            return None
+        lo = max(lo, min_depth)
+        hi = min(hi, np.nanmax(at) + offset)
+
+    depth = layers[0][0].depth.values
+    depth = depth[(depth >= lo) & (depth <= hi)]
+    if times.size == 0 or depth.size == 0:
+        return None
+    return times, depth
+
+
+def render(layers, vmin=-80, vmax=-30, offset=3, min_depth=25, block_pings=BLOCK_PINGS):
+    """
+    Depth x ping x 3 uint8 image of three channels on their shared grid, or
+    None when they have none. `layers` are (sv, bottom, linear): Sv as
+    ping_time x depth DataArrays (possibly lazily loaded, read one block of
+    pings at a time), bottom one depth per ping or None. Samples below a
+    channel's bottom + offset are blanked in that channel, as in
+    `echogram.render`.
+    """
+    grid = shared_grid(layers, offset, min_depth)
+    if grid is None:
+        return None
+    times, depth = grid
+
+    scale, shift = affine(vmin, vmax)
+    rgb = np.zeros((depth.size, times.size, 3), dtype=np.uint8)
+    for c, (sv, bottom, linear) in enumerate(layers):
+        pings = np.searchsorted(sv.ping_time.values, times)
+        rows, valid = nearest(sv.depth.values, depth)
+        if bottom is not None:
+            bottom = np.asarray(bottom)[pings]
+
+        for start in range(0, pings.size, block_pings):
+            stop = min(start + block_pings, pings.size)
+            block = np.asarray(sv.isel(ping_time=as_slice(pings[start:stop])))
+            buf = block[:, rows].astype(np.promote_types(block.dtype, np.float32))
+            buf[:, ~valid] = np.nan
+            if bottom is not None:
+                buf[depth[None, :] > bottom[start:stop, None] + offset] = np.nan
+
+            if linear:
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    np.log10(buf, out=buf)
+                buf *= 10 * scale
+            else:
+                buf *= scale
+            quantize(buf, shift, rgb[:, start:stop, c].T)
+    return rgb
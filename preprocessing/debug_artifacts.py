@@ -0,0 +1,89 @@
+"""
+Debug images of the preprocessing stage.
+
+These used to be full matplotlib figures for every file and frequency, which
+cost more than writing the echogram itself. DEBUG_ARTIFACTS selects:
+
+- off: no debug images (default)
+- sampled: the matplotlib figures, for one file in DEBUG_SAMPLE_EVERY,
+  picked by a hash of its name so re-runs sample the same files
+- fast: a small greyscale JPEG for every file, drawn directly with PIL from
+  a strided read of the data
+
+Matplotlib is only imported in sampled mode.
+"""
+
+from threading import Lock
+from zlib import crc32
+
+import numpy as np
+from PIL import Image
+
+import echogram
+
+MODES = ("off", "sampled", "fast")
+
+# Upper bound on the (width, height) of fast debug images
+THUMBNAIL = (1024, 512)
+
+# pyplot keeps global state; channels may be rendered on several threads
+_pyplot = Lock()
+
+
+def wanted(stem, mode, every=100):
+    """Whether debug images are written for the file `stem`."""
+    if mode == "fast":
+        return True
+    if mode == "sampled":
+        return crc32(stem.encode()) % max(every, 1) == 0
+    return False
+
+
+def thumbnail(sv, depth, linear=True, vmin=-80, vmax=-30, size=THUMBNAIL):
+    """
+    Depth x ping greyscale image of `sv` (ping_time x depth) reading at most
+    about `size` samples: lazily loaded arrays are read with a stride.
+    """
+    ping_step = -(-sv.shape[0] // size[0])
+    depth_step = -(-sv.shape[1] // size[1])
+    image, _ = echogram.render(
+        sv[::ping_step, ::depth_step],
+        np.asarray(depth)[::depth_step],
+        vmin=vmin,
+        vmax=vmax,
+        linear=linear,
+    )
+    return None if image is None else Image.fromarray(image)
+
+
+def save_sv(path, sv, mode, linear=True, vmin=-80, vmax=-30):
+    """Save a channel of Sv (ping_time x depth DataArray) before any cropping."""
+    if mode == "fast":
+        img = thumbnail(sv, sv.depth.values, linear, vmin, vmax)
+        if img is not None:
+            img.save(path, quality=85)
+        return
+
+    import matplotlib.pyplot as plt
+
+    db = 10 * np.log10(sv) if linear else sv
+    with _pyplot:
+        plt.imshow(db.T, aspect="auto", vmin=vmin, vmax=vmax)
+        plt.savefig(path)
+        plt.close()
+
+
+def save_image(path, img, mode):
+    """Save a preview of a finished echogram (PIL image)."""
+    if mode == "fast":
+        img = img.copy()
+        img.thumbnail(THUMBNAIL)
+        img.save(path, quality=85)
+        return
+
+    import matplotlib.pyplot as plt
+
+    with _pyplot:
+        plt.imshow(img, aspect="auto")
+        plt.savefig(path)
+        plt.close()
@@ -0,0 +1,171 @@
+"""
+Vectorized echogram rendering.
+
+Turns one channel of Sv into the uint8 image written by `sv_to_jpg` in a
+single pass over blocks of pings. The log transform, bottom/surface masking
+and a single clipped affine map to uint8 all run in one reused float buffer,
+where the xarray chain (`dropna`, `10 * log10`, two `where(..., drop=True)`,
+matplotlib's `Normalize`) copied the whole channel at every step.
+"""
+
+from functools import lru_cache
+
+import numpy as np
+
+# Pings converted per block; bounds the float scratch buffer
+BLOCK_PINGS = 1024
+
+
+def affine(vmin, vmax):
+    """Scale and shift of the map from dB to pixels: dB * scale + shift."""
+    scale = 255 / (vmax - vmin)
+    return scale, -vmin * scale
+
+
+def quantize(buf, shift, out):
+    """
+    Shift already scaled values by `shift`, clip to 0..255 and truncate into
+    the uint8 `out`, with NaN written as 0. `buf` is overwritten.
+    """
+    buf += shift
+    np.clip(buf, 0, 255, out=buf)
+    np.nan_to_num(buf, copy=False, nan=0.0)
+    np.copyto(out, buf, casting="unsafe")
+
+
+@lru_cache(maxsize=None)
+def colormap_lut(name):
+    """
+    256 x 3 uint8 RGB table for the matplotlib colormap `name`. Matplotlib is
+    only imported here, once per process, never while rendering.
+    """
+    from matplotlib import colormaps
+
+    rgba = colormaps[name](np.arange(256))
+    return np.round(rgba[:, :3] * 255).astype(np.uint8)
+
+
+def apply_colormap(image, name):
+    """Expand a uint8 echogram into an RGB image through a colormap LUT."""
+    return colormap_lut(name)[image]
+
+
+def iter_blocks(sv, block_pings=BLOCK_PINGS):
+    """
+    Yield (start, stop, block) over blocks of pings of `sv`. Lazily loaded
+    DataArrays are read from disk one block at a time.
+    """
+    for start in range(0, sv.shape[0], block_pings):
+        stop = min(start + block_pings, sv.shape[0])
+        yield start, stop, np.asarray(sv[start:stop])
+
+
+def as_slice(index):
+    """Turn a run of consecutive indices into a slice, so indexing is a view."""
+    if index.size and index[-1] - index[0] + 1 == index.size:
+        return slice(index[0], index[-1] + 1)
+    return index
+
+
+def to_db(block):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return 10 * np.log10(block)
+
+
+def render(
+    sv,
+    depth,
+    bottom=None,
+    vmin=-80,
+    vmax=-30,
+    linear=True,
+    offset=3,
+    min_depth=25,
+    block_pings=BLOCK_PINGS,
+):
+    """
+    Render `sv` (ping_time x depth, linear or dB) as a depth x ping uint8 image.
+
+    Depth rows holding NaN in any ping are dropped, as `dropna(dim="depth")`
+    did. With `bottom` (one depth per ping, NaN where unknown) pings without a
+    bottom are dropped, the image is cropped to [min_depth, max(bottom) +
+    offset], samples below bottom + offset are blanked and the boolean
+    depth x ping mask of kept samples is returned too.
+
+    `sv` may be a lazily loaded DataArray; only one block of pings is read
+    into memory at a time.
+
+    Returns (image, mask), with image None when nothing is left to draw.
+    """
+    depth = np.asarray(depth)
+    n_pings = sv.shape[0]
+
+    if bottom is not None:
+        bottom = np.asarray(bottom, dtype=float)
+        pings = np.flatnonzero(~np.isnan(bottom))
+        if pings.size == 0:
+            return None, None
+        cols = np.flatnonzero(
+            (depth >= min_depth) & (depth <= bottom[pings].max() + offset)
+        )
+    else:
+        pings = np.arange(n_pings)
+        cols = np.arange(depth.size)
+
+    # Depth is sorted, so the crop is normally a slice and blocks stay views
+    cols = as_slice(cols)
+
+    scale, shift = affine(vmin, vmax)
+    dtype = np.promote_types(sv.dtype, np.float32)
+    n_cols = len(depth[cols])
+    buf = np.empty((min(block_pings, n_pings), n_cols), dtype=dtype)
+    image = np.empty((n_cols, pings.size), dtype=np.uint8)
+    bad = np.zeros(depth.shape, dtype=bool)
+
+    done = 0
+    for start, stop, block in iter_blocks(sv, block_pings):
+        bad |= np.isnan(block).any(axis=0)
+
+        rows = pings[done : done + stop - start]
+        rows = rows[rows < stop] - start
+        if rows.size == 0:
+            continue
+        if rows.size == stop - start:
+            src = block[:, cols]
+        else:
+            src = block[rows][:, cols]
+
+        # dB * scale, with the 10 of 10 * log10 folded into the scale
+        out = buf[: rows.size]
+        if linear:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                np.log10(src, out=out)
+            out *= 10 * scale
+        else:
+            np.multiply(src, scale, out=out)
+        quantize(out, shift, image[:, done : done + rows.size].T)
+        done += rows.size
+
+    valid = depth[~bad]
+    if valid.size == 0:
+        return None, None
+    keep_rows = ~bad[cols]
+
+    mask = None
+    if bottom is not None:
+        below = depth[cols]
+        mask = (below[:, None] <= bottom[pings] + offset) & (below >= min_depth)[
+            :, None
+        ]
+        image[~mask] = 0
+
+        # Pings whose bottom lies above every remaining depth drop out
+        keep_pings = bottom[pings] + offset >= valid.min()
+        if not keep_pings.all():
+            image, mask = image[:, keep_pings], mask[:, keep_pings]
+        mask = mask[keep_rows]
+    image = image[keep_rows] if not keep_rows.all() else image
+
+    if image.size == 0 or (mask is not None and not mask.any()):
+        return None, None
+    return image, mask
@@ -1,14 +1,22 @@
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 import os
 import time
 import xarray as xr
 import numpy as np
-import matplotlib.pyplot as plt
+import netCDF4
 from PIL import Image
-import matplotlib.colors as clr
 import logging
 import gc
+import shutil
+import binning
+import composite
+import debug_artifacts
+import echogram
+import seafloor
+import tensor_shards
+import thresholds
+from scheduler import memory_budget, run_scheduled
 
 # Set up environment variables
 input_dir = os.getenv("INPUT_DIR", "/data/processed")
@@ -16,6 +24,52 @@ output_dir = os.getenv("OUTPUT_DIR", "/data/test_imgs")
 log_path = os.getenv("LOG_DIR", ".")
 keep_intermediates = os.getenv("KEEP_INTERMEDIATES", "true").lower() == "true"
 
+# Matplotlib colormap for RGB echograms (e.g. "viridis"); empty keeps greyscale
+colormap = os.getenv("COLORMAP", "")
+
+# Inputs are published atomically by stage 1; set PROBE_INPUTS=true to poll
+# and test-open them anyway, REQUIRE_SIDECAR=true to wait for <stem>.ready
+probe_inputs = os.getenv("PROBE_INPUTS", "false").lower() == "true"
+require_sidecar = os.getenv("REQUIRE_SIDECAR", "false").lower() == "true"
+
+# Bottom lines detected when estimating the seafloor are kept under
+# OUTPUT_DIR/.bottom for retries and re-runs; BOTTOM_SMOOTH median filters
+# them over that many pings (0 disables) and masks and blanks the samples
+# below the smoothed line + 3 m
+bottom_cache = os.getenv("BOTTOM_CACHE", "true").lower() == "true"
+bottom_smooth = int(os.getenv("BOTTOM_SMOOTH", 0))
+
+# Save masks bit-packed (<freq>_mask.npz, see thresholds.load_mask) instead
+# of one byte per sample (<freq>_mask.npy)
+packed_masks = os.getenv("MASK_FORMAT", "npy").lower() == "packed"
+
+# Average Sv over PING_BIN x DEPTH_BIN cells (linear domain) before rendering
+ping_bin = int(os.getenv("PING_BIN", 1))
+depth_bin = int(os.getenv("DEPTH_BIN", 1))
+
+# Echogram outputs: png, tensor (tensors.npy + index.json at the inference
+# resolution TENSOR_SIZE, see tensor_shards) or both
+output_format = os.getenv("OUTPUT_FORMAT", "png").lower()
+write_png = output_format in ("png", "both")
+write_tensors = output_format in ("tensor", "both")
+tensor_size = int(os.getenv("TENSOR_SIZE", 5000))
+
+# Debug images: off, sampled (matplotlib figures for one file in
+# DEBUG_SAMPLE_EVERY) or fast (PIL thumbnails for every file)
+debug_mode = os.getenv("DEBUG_ARTIFACTS", "off").lower()
+debug_sample_every = int(os.getenv("DEBUG_SAMPLE_EVERY", 100))
+
+# Three frequencies (Hz) packed into the R, G and B channels of composite.png,
+# e.g. 38000,120000,200000; empty for greyscale echograms only
+composite_freqs = composite.parse_freqs(os.getenv("COMPOSITE_FREQS", ""))
+
+# Threads rendering the channels of one file (0 splits MAX_WORKERS across
+# the batch, as in stage 1)
+channel_workers = int(os.getenv("CHANNEL_WORKERS", 0))
+
+# Peak memory of one file as a multiple of its largest decoded channel
+memory_factor = float(os.getenv("MEMORY_FACTOR", 1))
+
 # Set up logging configuration
 log_file = os.path.join(log_path, "pipeline.log")
 logging.basicConfig(
@@ -27,156 +81,414 @@ logging.basicConfig(
 log = logging.getLogger()
 
 
+# Intermediate stores written by the conversion stage
+INPUT_PATTERNS = ("*.nc", "*.zarr")
+
+
+def glob_inputs(inp):
+    return [f for pattern in INPUT_PATTERNS for f in inp.glob(pattern)]
+
+
 def reduce_files_to_diff(inp, out):
     in_files = {
         f.stem
-        for f in inp.glob("*.nc")
+        for f in glob_inputs(inp)
         if not (f.with_suffix(".processed")).exists()
         and not (f.with_suffix(".failed")).exists()
+        and (not require_sidecar or f.with_suffix(".ready").exists())
     }
     out_files = {f.stem for f in out.glob("*")}
     diff = in_files - out_files
     print(diff)
-    return filter(lambda x: x.stem in diff, inp.glob("*.nc"))
+    return filter(lambda x: x.stem in diff, glob_inputs(inp))
+
+
+def list_groups(file: Path):
+    if file.suffix == ".zarr":
+        import zarr  # Only needed for Zarr inputs
+
+        return list(zarr.open_group(str(file), mode="r").group_keys())
+    with netCDF4.Dataset(file) as nc:
+        return list(nc.groups)
+
+
+def open_store(file: Path):
+    """
+    Open `file` lazily as a dict of group name -> Dataset (dense: root only).
+    Without caching, reading a block of Sv never keeps the whole variable.
+    """
+    store = {None: xr.open_dataset(file, cache=False)}
+    if store[None].attrs.get("layout") == "ragged":
+        for group in list_groups(file):
+            store[group] = xr.open_dataset(file, group=group, cache=False)
+    return store
+
+
+def iter_channels(store, dropna=True):
+    """
+    Yield (frequency, Sv, bottom_depth or None) for every channel in a store
+    (or in the file it is opened from).
+
+    Understands both the dense frequency cube and the ragged layout, where
+    each channel is its own group on its native depth grid. With
+    `dropna=False` Sv and bottom_depth keep their full, lazily loaded grids,
+    NaN padding included.
+    """
+    if not isinstance(store, dict):
+        store = open_store(store)
+    ds = store[None]
+
+    if ds.attrs.get("layout") == "ragged":
+        for group, channel in store.items():
+            if group is None:
+                continue
+            bottom = None
+            sv = channel.Sv
+            if "bottom_depth" in channel:
+                bottom = channel["bottom_depth"]
+            if dropna:
+                sv = sv.dropna(dim="depth")
+                bottom = None if bottom is None else bottom.dropna(dim="ping_time")
+            yield float(channel.attrs["frequency"]), sv, bottom
+        return
+
+    for freq in ds.frequency:
+        bottom = None
+        sv = ds.Sv.sel(frequency=freq)
+        if "bottom_depth" in ds:
+            bottom = ds["bottom_depth"].sel(frequency=freq)
+        if dropna:
+            sv = sv.dropna(dim="depth")
+            bottom = None if bottom is None else bottom.dropna(dim="ping_time")
+        yield float(freq), sv, bottom
 
 
-# Process the seafloor data
-def process_seafloor(ds: xr.DataArray, depth0=25, backstep=5):
+# Sv is stored linear unless the conversion stage packed it in dB
+def to_db(sv: xr.DataArray):
+    if sv.attrs.get("units") == "dB":
+        return sv
+    return 10 * np.log10(sv)
+
+
+# Process the seafloor data. Depth rows holding NaN are dropped, as
+# dropna(dim="depth") did, found in the same read as the bottom. With `cache`
+# (path of a bottom-line file and the key it must match) a previously
+# detected bottom is reused and the data is not read at all.
+def process_seafloor(ds: xr.DataArray, depth0=25, backstep=5, cache=None):
     ds.attrs["tag"] = "bd2-d%i-bs%i" % (depth0, backstep)
-    ds = ds.where(ds.depth >= depth0, drop=True)
-    max_depth = ds.idxmax("depth").compute()
-    bottom_median = max_depth.median()
-    ds = ds.where(ds.depth <= 1.15 * bottom_median, drop=True)
-    bottom_depth = ds.idxmax("depth").compute()
+
+    found = seafloor.load_bottom(*cache, ds.shape) if cache else None
+    if found is None:
+        found = seafloor.detect_bottom(
+            ds, ds.depth.values, min_depth=depth0, smooth=bottom_smooth
+        )
+        if cache:
+            seafloor.save_bottom(*cache, *found)
+    bottom, max_depth, bad = found
+
+    ds = ds.isel(depth=echogram.as_slice(np.flatnonzero(~bad)))
+    depth = ds.depth.values
+    lo, hi = np.searchsorted(depth, depth0), np.searchsorted(depth, max_depth, "right")
+    ds = ds.isel(depth=slice(lo, hi))
+    bottom_depth = xr.DataArray(
+        bottom, coords={"ping_time": ds.ping_time}, dims=["ping_time"]
+    )
     ds["bottom_depth"] = bottom_depth
     return ds, bottom_depth
 
 
-# Function to convert Sv data to colors
+# Function to convert Sv data (dB) to 0..255 grey levels
 def to_colors(sv, vmin=-80, vmax=-30):
-    norm = clr.Normalize(vmin=vmin, vmax=vmax, clip=True)
-    y = norm(sv)
-    return y * 255
+    scale, shift = echogram.affine(vmin, vmax)
+    return np.clip(np.asarray(sv, dtype=float) * scale + shift, 0, 255)
 
 
 # Apply a sigma threshold to the data
 def sigma_thresholding_upper(data, sigma=3):
-    flattened_data = data.values.flatten()
-    mean = np.nanmean(flattened_data)
-    std_dev = np.nanstd(flattened_data)
-    upper_bound = mean + sigma * std_dev
-    thresholded_data = data.where(data <= upper_bound)
+    _, mean, var = thresholds.nan_stats(data.values)
+    upper_bound = mean + sigma * np.sqrt(var)
     binary_mask = data <= upper_bound
-    nanmean_value = np.nanmean(flattened_data)
-    filled_data = thresholded_data.fillna(nanmean_value)
+    filled_data = data.where(binary_mask).fillna(mean)
     return filled_data, binary_mask
 
 
-# Process and save Sv data to image and mask files
-def sv_to_jpg(file, vmin=-80, vmax=-30, estimate_bot=False):
-    ds = xr.open_dataset(file)
-    base_out = Path(output_dir)
-    success = False
-
-    for freq in ds.frequency:
-        freq_data = ds.Sv.sel(frequency=freq).dropna(dim="depth")
-        freq_data = 10 * np.log10(freq_data)
-        mask = None
+# Outcomes of render_channel, applied in channel order by sv_to_jpg
+SAVED, SKIPPED, INVALID, EMPTY, FAILED, NO_SEAFLOOR = (
+    "saved",
+    "skipped",
+    "invalid",
+    "empty",
+    "failed",
+    "no_seafloor",
+)
 
-        if freq_data.size == 0:
-            log.warning(
-                f"No valid Sv data for frequency {freq.data} in file {file.stem}. Skipping."
-            )
-            success = False
-            continue
 
-        if "bottom_depth" in ds:
-            offset = 3
-            bottom_depth = (
-                ds["bottom_depth"].sel(frequency=freq).dropna(dim="ping_time")
-            )
-            freq_data = freq_data.where(
-                freq_data.depth <= bottom_depth + offset, drop=True
+# Render one channel into the staging folder. Returns (outcome, tensor shard
+# entry or None, composite layer (frequency, (Sv, bottom, linear)) or None); runs on
+# a worker thread when channels are processed together.
+def render_channel(
+    file, freq, freq_data, bottom_depth, vmin, vmax, estimate_bot, staging, cache, debug
+):
+    linear = freq_data.attrs.get("units") != "dB"
+    mask = None
+
+    if ping_bin > 1 or depth_bin > 1:
+        freq_data, bottom_depth = binning.downsample(
+            freq_data, bottom_depth, ping_bin, depth_bin, linear=linear
+        )
+    mask_shape = None  # Set when `mask` holds packed bits
+    seabed = None  # Depth x ping samples below the smoothed seafloor
+
+    if bottom_depth is None and estimate_bot:
+        # NaN depth rows included; the echogram below drops them
+        if debug and freq_data.size:
+            debug_artifacts.save_sv(
+                Path(log_path) / f"{file.stem}_debug.jpg",
+                freq_data,
+                debug_mode,
+                linear=linear,
             )
-            freq_data = freq_data.where(freq_data.depth >= 25, drop=True)
-            mask = (freq_data.depth <= bottom_depth + offset) & (freq_data.depth >= 25)
-        elif estimate_bot:
-            debug_path = Path(log_path)
-            plt.imshow(freq_data.T, aspect="auto", vmin=-80, vmax=-30)
-            plt.savefig(debug_path / f"{file.stem}_debug.jpg")
-            plt.clf()
-
-            try:
-                freq_data, bottom_depth = process_seafloor(freq_data)
-            except ValueError as e:
-                log.error(
-                    f"Seafloor processing failed for file {file.stem}, frequency {freq.data}: {e}"
-                )
-                mark_as_failed(file)  # Mark the file as failed
-                return False  # Skip further processing for this file
-
-            _, mask = sigma_thresholding_upper(freq_data)
-            print(mask.shape)
 
-        sv = np.array(freq_data.data)
-
-        if sv.size == 0 or np.isnan(sv).all():
+        # NaN depth rows are found in the same read as the seafloor
+        try:
+            freq_data, bottom_depth = process_seafloor(freq_data, cache=cache)
+        except seafloor.NoData:
             log.warning(
-                f"Empty or invalid Sv data for frequency {freq.data} in file {file.stem}. Skipping."
+                f"No valid Sv data for frequency {freq} in file {file.stem}. Skipping."
             )
-            continue
-
-        sv_colors = to_colors(sv, vmin, vmax)
-
-        img = Image.fromarray(sv_colors.T.astype(np.uint8))
-        img = img.convert("L")
-
-        log.info(f"Saving image for frequency {freq.data} with shape {img.size}")
-
-        save_path = base_out / file.stem
-        save_path.mkdir(parents=True, exist_ok=True)
-
-        img_file = save_path / f"{int(freq.data)}.png"
-        mask_file = save_path / f"{int(freq.data)}_mask.npy"
-
-        if img.size[0] == 0 or img.size[1] == 0:
-            log.warning(
-                f"Generated an empty image for frequency {freq.data}. Skipping."
+            return SKIPPED, None, None
+        except ValueError as e:
+            log.error(
+                f"Seafloor processing failed for file {file.stem}, frequency {freq}: {e}"
             )
-            continue
+            return NO_SEAFLOOR, None, None
+
+        # Only the mask is kept, so skip the filled copy of the data
+        mask = thresholds.upper_mask(
+            freq_data,
+            packed=packed_masks,
+            transform=echogram.to_db if linear else None,
+        )
+        if packed_masks:
+            mask_shape = freq_data.shape
+        print(mask.shape)
+
+        if bottom_smooth > 1:
+            # Mask and blank below the smoothed bottom line, as make_figure.py
+            # does by hand; the composite blanks it too
+            water = freq_data.depth.values <= bottom_depth.values[:, None] + 3
+            mask &= thresholds.pack_mask(water) if packed_masks else water
+            seabed = ~water.T
+        else:
+            bottom_depth = None  # Already cropped to the estimated seafloor
+
+    # Kept for the RGB composite, rendered from all its channels at once
+    layer = None
+    if int(freq) in composite_freqs:
+        bottom = None if bottom_depth is None else bottom_depth.values
+        layer = (int(freq), (freq_data, bottom, linear))
+
+    if seabed is not None:
+        bottom_depth = None  # Already cropped, blanked below
+
+    # Log transform, bottom masking and quantization in one pass
+    sv_colors, bottom_mask = echogram.render(
+        freq_data,
+        freq_data.depth.values,
+        bottom=None if bottom_depth is None else bottom_depth.values,
+        vmin=vmin,
+        vmax=vmax,
+        linear=linear,
+    )
+    if bottom_mask is not None:
+        mask = bottom_mask
+        if packed_masks:
+            mask, mask_shape = thresholds.pack_mask(mask), mask.shape
+
+    if sv_colors is None:
+        log.warning(
+            f"Empty or invalid Sv data for frequency {freq} in file {file.stem}. Skipping."
+        )
+        return INVALID, None, None
+    if seabed is not None:
+        sv_colors[seabed] = 0
+
+    if colormap:
+        sv_colors = echogram.apply_colormap(sv_colors, colormap)
+    img = Image.fromarray(sv_colors)
+
+    log.info(f"Saving image for frequency {freq} with shape {img.size}")
+
+    save_path = staging
+    save_path.mkdir(parents=True, exist_ok=True)
+
+    img_file = save_path / f"{int(freq)}.png"
+    mask_file = save_path / f"{int(freq)}_mask.{'npz' if packed_masks else 'npy'}"
+
+    if img.size[0] == 0 or img.size[1] == 0:
+        log.warning(f"Generated an empty image for frequency {freq}. Skipping.")
+        return EMPTY, None, None
+
+    if debug:
+        debug_artifacts.save_image(
+            save_path / f"{int(freq)}_debug.jpg", img, debug_mode
+        )
 
-        plt.imshow(img, aspect="auto")
-        plt.savefig(save_path / f"{int(freq.data)}_debug.jpg")
-
-        try:
+    try:
+        tensor = None
+        if write_png:
             img.save(img_file)
-            if mask is not None:
-                np.save(mask_file, mask)
+        if write_tensors:
+            tensor = (str(int(freq)), tensor_shards.resize(img, tensor_size))
+        if mask is not None:
+            thresholds.save_mask(mask_file, mask, mask_shape)
+
+        if (not write_png or img_file.exists()) and (
+            mask is None or mask_file.exists()
+        ):
+            return SAVED, tensor, layer
+        log.error(
+            f"Failed to save files for frequency {freq} in file {file.stem}. Aborting."
+        )
+    except Exception as e:
+        log.error(f"Error saving image or mask for frequency {freq}: {e}")
+    return FAILED, None, None
+
+
+# Process and save Sv data to image and mask files. An in-memory `store`
+# (as built by the conversion stage) is used instead of reading `file`.
+# With `workers` > 1 the channels of the file are rendered on a thread pool;
+# NumPy, zlib and PIL release the GIL for the heavy parts.
+def sv_to_jpg(
+    file,
+    vmin=-80,
+    vmax=-30,
+    estimate_bot=False,
+    store=None,
+    out_dir=None,
+    workers=1,
+):
+    base_out = Path(out_dir or output_dir)
+    success = False
 
-            if img_file.exists() and (mask is None or mask_file.exists()):
-                success = True
-            else:
+    # Outputs are staged and published in one rename, see publish_dir
+    staging = base_out / ".tmp" / file.stem
+    shutil.rmtree(staging, ignore_errors=True)
+
+    debug = debug_artifacts.wanted(file.stem, debug_mode, debug_sample_every)
+    tensors = []  # (name, resized array) for the tensor shard
+    layers = []  # (frequency, (Sv, bottom, linear)) for the composite
+
+    def render(channel):
+        freq, freq_data, bottom_depth = channel
+        cache = None
+        if estimate_bot and bottom_cache and store is None:
+            cache_file = base_out / ".bottom" / file.stem / f"{int(freq)}.npz"
+            key = seafloor.cache_key(
+                file, smooth=bottom_smooth, ping_bin=ping_bin, depth_bin=depth_bin
+            )
+            cache = (cache_file, key)
+        return render_channel(
+            file,
+            freq,
+            freq_data,
+            bottom_depth,
+            vmin,
+            vmax,
+            estimate_bot,
+            staging,
+            cache,
+            debug,
+        )
+
+    channels = iter_channels(store or file, dropna=False)
+    no_seafloor = False
+    # Leaving the pool waits for running channels, so staging is only
+    # cleaned up once nothing writes to it anymore
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        # Serially, a failing channel stops the rest like a plain loop would
+        outcomes = pool.map(render, channels) if workers > 1 else map(render, channels)
+
+        for outcome, tensor, layer in outcomes:
+            if outcome == NO_SEAFLOOR:
+                no_seafloor = True
+                break
+            if outcome == FAILED:
                 success = False
-                log.error(
-                    f"Failed to save files for frequency {freq.data} in file {file.stem}. Aborting."
-                )
                 mark_as_failed(file)  # Mark the file as failed
                 break
+            if outcome == SKIPPED:
+                success = False
+            elif outcome == SAVED:
+                success = True
+                if tensor is not None:
+                    tensors.append(tensor)
+                if layer is not None:
+                    layers.append(layer)
+        pool.shutdown(cancel_futures=True)
+
+    if no_seafloor:
+        mark_as_failed(file)  # Mark the file as failed
+        shutil.rmtree(staging, ignore_errors=True)
+        return False  # Skip further processing for this file
+
+    if success and composite_freqs:
+        tensors = save_composite(file, staging, dict(layers), tensors, vmin, vmax)
+    if success and tensors:
+        tensor_shards.write_shard(staging, tensors)
+    if success:
+        publish_dir(staging, base_out / file.stem)
+    else:
+        shutil.rmtree(staging, ignore_errors=True)
+    return success
 
-        except Exception as e:
-            success = False
-            log.error(f"Error saving image or mask for frequency {freq.data}: {e}")
-            mark_as_failed(file)  # Mark the file as failed
-            break
 
-    return success
+# Render the COMPOSITE_FREQS channels of a file into one RGB image on their
+# shared ping/depth grid. With a composite the tensor shard holds only that
+# entry, as its 3 channels don't stack with greyscale entries and inference
+# only reads the composite.
+def save_composite(file, staging, layers, tensors, vmin=-80, vmax=-30):
+    missing = [f for f in composite_freqs if f not in layers]
+    if missing:
+        log.warning(f"No composite for file {file.stem}: missing frequencies {missing}")
+        return tensors
+
+    rgb = composite.render([layers[f] for f in composite_freqs], vmin, vmax)
+    if rgb is None:
+        log.warning(
+            f"No composite for file {file.stem}: frequencies {composite_freqs} "
+            "share no pings or depths"
+        )
+        return tensors
+
+    img = Image.fromarray(rgb)
+    if write_png:
+        img.save(staging / f"{composite.NAME}.png")
+    if write_tensors:
+        return [(composite.NAME, tensor_shards.resize(img, tensor_size))]
+    return tensors
+
+
+# Move a fully written output folder into place in one rename, so the
+# inference stage never picks up a sample with only some frequencies
+def publish_dir(staging: Path, final: Path):
+    if final.exists():
+        shutil.rmtree(final)
+    os.replace(staging, final)
+    log.info(f"Published {final}")
 
 
 def mark_as_processed(file: Path):
     try:
         if not keep_intermediates:
-            file.unlink()
+            if file.is_dir():
+                shutil.rmtree(file)  # Zarr stores are directories
+            else:
+                file.unlink(missing_ok=True)
             log.info(f"Deleted intermediate file {file}")
+            file.with_suffix(".ready").unlink(missing_ok=True)
+            # Cached bottom lines can never be reused once their source is gone
+            shutil.rmtree(Path(output_dir) / ".bottom" / file.stem, ignore_errors=True)
         marker_file = file.with_suffix(".processed")
         marker_file.touch()
         log.info(f"Created marker file {marker_file}")
@@ -225,16 +537,18 @@ def mark_as_failed(file: Path):
 
 
 # Process an individual file
-def process_file(file: Path, output_dir: Path):
+def process_file(file: Path, output_dir: Path, workers=1):
     max_attempts = 4
     try:
-        if not is_file_ready(file, retries=20, wait_time=2):
+        # Stage 1 publishes outputs atomically, so probing is only needed for
+        # producers that write in place
+        if probe_inputs and not is_file_ready(file, retries=20, wait_time=2):
             log.error(f"Skipping file {file}: not ready after retries.")
             mark_as_failed(file)
             return
 
         for attempt in range(max_attempts):
-            if sv_to_jpg(file, estimate_bot=True):
+            if sv_to_jpg(file, estimate_bot=True, workers=workers):
                 mark_as_processed(file)
                 return
             log.warning(f"Attempt {attempt + 1}/{max_attempts} failed for {file}")
@@ -249,23 +563,52 @@ def process_file(file: Path, output_dir: Path):
         gc.collect()
 
 
+# Estimate peak memory from the size of the largest channel, read from metadata
+# only. Up to `workers` channels are rendered at once.
+def estimate_memory(file: Path, workers=1):
+    try:
+        with xr.open_dataset(file) as ds:
+            if ds.attrs.get("layout") == "ragged":
+                sizes = []
+                for group in list_groups(file):
+                    with xr.open_dataset(file, group=group) as channel:
+                        sizes.append(channel.Sv.size)
+            else:
+                n = max(ds.sizes.get("frequency", 1), 1)
+                sizes = [ds.Sv.size // n] * n
+        largest = sum(sorted(sizes, reverse=True)[: max(workers, 1)])
+        return int(memory_factor * 8 * largest)
+    except Exception as e:
+        log.warning(f"Could not estimate memory for {file}: {e}")
+        return int(memory_factor * file.stat().st_size)
+
+
 # Process all files in a directory
 def consume_dir(input_dir: Path, output_dir: Path, max_workers=None):
     if max_workers is None:
         max_workers = int(os.getenv("MAX_WORKERS", os.cpu_count() or 4))
     files_to_compute = list(reduce_files_to_diff(input_dir, output_dir))
 
-    logging.info(f"Starting to process {len(files_to_compute)} files in parallel.")
+    # Hand cores left idle by a small batch to the channels inside each file
+    workers = channel_workers or max(1, max_workers // max(len(files_to_compute), 1))
+    budget = memory_budget()
 
-    # Process files in parallel using ProcessPoolExecutor
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        future_to_file = {
-            executor.submit(process_file, file, output_dir): file
-            for file in files_to_compute
-        }
+    logging.info(
+        f"Starting to process {len(files_to_compute)} files in parallel "
+        f"with {workers} channel workers each and a {budget / 2**30:.1f} GiB memory budget."
+    )
 
-        for future in as_completed(future_to_file):
-            file = future_to_file[future]
+    # Process files in parallel, admitting them against the memory budget
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        scheduled = run_scheduled(
+            files_to_compute,
+            lambda file: executor.submit(process_file, file, output_dir, workers),
+            lambda file: estimate_memory(file, workers),
+            budget,
+            max_workers,
+        )
+
+        for file, future in scheduled:
             try:
                 future.result()  # This will raise an exception if one occurred during processing
             except Exception as e:
@@ -0,0 +1,119 @@
+"""
+Vectorized seafloor detection.
+
+The bottom is taken as the depth of the strongest echo in every ping below
+`min_depth`, searched again within `window` times the median of those
+depths so that strong echoes far below the seafloor (multiples, noise) are
+ignored. Both searches are a single argmax over a NumPy view; only pings
+whose first maximum falls outside the window are searched twice. The depth
+rows holding NaN are found in the same read as the first search.
+
+Detected bottom lines can be saved next to the stage output, so retries and
+re-runs of a file skip the detection.
+"""
+
+from pathlib import Path
+import logging
+import os
+
+import numpy as np
+from scipy.ndimage import median_filter
+
+from echogram import as_slice, iter_blocks
+
+
+class NoData(ValueError):
+    """No ping or depth row of a channel holds data to search."""
+
+
+def detect_bottom(sv, depth, min_depth=25, window=1.15, smooth=0):
+    """
+    Detect the bottom in `sv` (ping_time x depth) on the sorted `depth` grid.
+    Sv may be linear or in dB, the strongest echo is the same, and may be a
+    lazily loaded DataArray, which is read in blocks of pings.
+
+    Depth rows holding NaN in any ping are left out, as dropna(dim="depth")
+    would; they are found in the same read of `sv` as the first search, so
+    a channel is read once, plus the pings searched again.
+
+    Returns (bottom depth per ping, deepest depth searched, NaN rows). With
+    `smooth` the bottom line is median filtered over that many pings, as done
+    by hand in make_figure.py. Raises NoData when no ping or row is valid and
+    ValueError when no depth is left to search.
+    """
+    depth = np.asarray(depth)
+    bad = np.zeros(depth.size, dtype=bool)
+    first = np.zeros(sv.shape[0], dtype=int)
+    lo = np.searchsorted(depth, min_depth, side="left")
+    for start, stop, block in iter_blocks(sv):
+        nan = np.isnan(block)
+        bad |= nan.any(axis=0)
+        if lo < depth.size:
+            below = np.where(nan[:, lo:], -np.inf, block[:, lo:])
+            first[start:stop] = lo + np.argmax(below, axis=1)
+    if sv.shape[0] == 0 or bad.all():
+        raise NoData("no valid Sv data")
+
+    # From here on indices are into the rows without NaN
+    good = np.flatnonzero(~bad)
+    redo = np.flatnonzero(bad[first])
+    first = np.searchsorted(good, first)
+    depth = depth[good]
+    lo = np.searchsorted(depth, min_depth, side="left")
+    if lo >= depth.size:
+        raise ValueError(f"no samples below {min_depth} m")
+
+    def search(pings, hi):
+        cols = as_slice(good[lo:hi])
+        for start, stop, block in iter_blocks(sv[pings][:, cols]):
+            first[pings[start:stop]] = lo + np.argmax(block, axis=1)
+
+    # Pings whose strongest echo lies in a row with NaN in other pings
+    search(redo, depth.size)
+    max_depth = window * np.median(depth[first])
+    hi = np.searchsorted(depth, max_depth, side="right")
+    if hi <= lo:
+        raise ValueError(f"no samples between {min_depth} and {max_depth:.1f} m")
+
+    # A maximum inside the window is also the maximum of the window
+    search(np.flatnonzero(first >= hi), hi)
+
+    bottom = depth[first]
+    if smooth > 1:
+        bottom = median_filter(bottom, size=smooth, mode="nearest")
+    return bottom, max_depth, bad
+
+
+def cache_key(file: Path, **params):
+    """Identify a bottom line by its source file version and detector settings."""
+    stat = os.stat(file)
+    settings = ",".join(f"{k}={v}" for k, v in sorted(params.items()))
+    return f"{stat.st_size}:{stat.st_mtime_ns}:{settings}"
+
+
+def load_bottom(path: Path, key, shape):
+    """
+    Cached (bottom, max_depth, NaN rows) for `key` and a channel of `shape`
+    (pings, depths), or None when missing or stale.
+    """
+    try:
+        with np.load(path) as cached:
+            if str(cached["key"]) != key or (
+                cached["bottom"].shape + cached["bad"].shape != tuple(shape)
+            ):
+                return None
+            return cached["bottom"], float(cached["max_depth"]), cached["bad"]
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def save_bottom(path: Path, key, bottom, max_depth, bad):
+    """Write a bottom line atomically, so a crashed write is never loaded."""
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}")
+        with open(tmp, "wb") as f:
+            np.savez(f, key=key, bottom=bottom, max_depth=max_depth, bad=bad)
+        os.replace(tmp, path)
+    except OSError as e:
+        logging.warning(f"Could not cache bottom line {path}: {e}")
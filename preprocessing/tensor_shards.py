@@ -0,0 +1,39 @@
+"""
+Inference-ready tensor shards.
+
+Instead of (or next to) one PNG per frequency, a sample folder can hold
+
+- tensors.npy: uint8 (n, H, W, C) echograms, already resized to the
+  inference resolution the way the inference stage resizes PNGs
+  (PIL bilinear), C being 1 for greyscale or 3 for colormapped images;
+- index.json: the shape of that array and the name of every entry.
+
+The inference stage memory-maps tensors.npy and batches entries without
+decoding or resizing anything.
+"""
+
+import json
+
+import numpy as np
+from PIL import Image
+
+TENSORS = "tensors.npy"
+INDEX = "index.json"
+
+
+def resize(img: Image.Image, size):
+    """`img` resized to `size` x `size` as an (H, W, C) uint8 array."""
+    array = np.asarray(img.resize((size, size), Image.BILINEAR))
+    return array[..., None] if array.ndim == 2 else array
+
+
+def write_shard(folder, entries):
+    """Write (name, (H, W, C) array) entries of one sample into `folder`."""
+    names = [name for name, _ in entries]
+    np.save(folder / TENSORS, np.stack([array for _, array in entries]))
+    index = {
+        "shape": [len(entries), *entries[0][1].shape],
+        "dtype": "uint8",
+        "entries": [{"name": name, "index": i} for i, name in enumerate(names)],
+    }
+    (folder / INDEX).write_text(json.dumps(index, indent=2))
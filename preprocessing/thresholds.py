@@ -0,0 +1,102 @@
+"""
+Single-pass, NaN-aware statistics and threshold masks.
+
+Mean and variance are accumulated over blocks of rows and merged with Chan
+et al.'s parallel form of Welford's update, so an echogram is read once and
+never flattened or copied as a whole. Masks are written block by block,
+optionally packed to one bit per sample.
+"""
+
+import numpy as np
+
+# Samples per block; bounds the temporaries of one statistics/mask step
+BLOCK = 1 << 20
+
+
+def iter_blocks(data, block=BLOCK, transform=None):
+    """
+    Yield (start, stop, array) over blocks of whole rows of `data`, a NumPy
+    array or a lazily loaded DataArray read one block at a time. `transform`
+    is applied to every block, e.g. to convert linear Sv to dB.
+    """
+    row = max(int(np.prod(data.shape[1:])), 1)
+    step = max(block // row, 1)
+    for start in range(0, data.shape[0], step):
+        stop = min(start + step, data.shape[0])
+        chunk = np.asarray(data[start:stop])
+        yield start, stop, chunk if transform is None else transform(chunk)
+
+
+def nan_stats(data, block=BLOCK, transform=None):
+    """Count, mean and population variance of the non-NaN values of `data`."""
+    n, mean, m2 = 0, 0.0, 0.0
+    for _, _, chunk in iter_blocks(data, block, transform):
+        valid = chunk[~np.isnan(chunk)]
+        k = valid.size
+        if k == 0:
+            continue
+        chunk_mean = valid.mean(dtype=np.float64)
+        valid = valid - chunk_mean
+        chunk_m2 = float(np.dot(valid, valid))
+
+        delta = chunk_mean - mean
+        total = n + k
+        mean += delta * k / total
+        m2 += chunk_m2 + delta * delta * n * k / total
+        n = total
+
+    if n == 0:
+        return 0, np.nan, np.nan
+    return n, mean, m2 / n
+
+
+def upper_bound(data, sigma=3, block=BLOCK, transform=None):
+    """mean + sigma * std of the non-NaN values of `data`."""
+    _, mean, var = nan_stats(data, block, transform)
+    return mean + sigma * np.sqrt(var)
+
+
+def upper_mask(data, sigma=3, packed=False, block=BLOCK, transform=None):
+    """
+    True where `data` <= mean + sigma * std (NaN is False), taking two passes
+    over `data`. With `packed` the mask is returned bit-packed along the last
+    axis (see `pack_mask`) and never held as one byte per sample.
+    """
+    bound = upper_bound(data, sigma, block, transform)
+
+    if packed:
+        shape = data.shape[:-1] + ((data.shape[-1] + 7) // 8,)
+        mask = np.empty(shape, dtype=np.uint8)
+    else:
+        mask = np.empty(data.shape, dtype=bool)
+
+    for start, stop, chunk in iter_blocks(data, block, transform):
+        with np.errstate(invalid="ignore"):
+            chunk_mask = chunk <= bound
+        mask[start:stop] = pack_mask(chunk_mask) if packed else chunk_mask
+    return mask
+
+
+def pack_mask(mask):
+    return np.packbits(mask, axis=-1)
+
+
+def save_mask(path, mask, shape=None):
+    """
+    Save a boolean mask as .npy, or, with `shape`, bits packed along the last
+    axis of a mask of that shape as .npz (see `load_mask`).
+    """
+    if shape is None:
+        np.save(path, mask)
+    else:
+        np.savez(path, bits=mask, shape=np.asarray(shape))
+
+
+def load_mask(path):
+    """Load a mask written by `save_mask`, unpacking bit-packed masks."""
+    if str(path).endswith(".npz"):
+        with np.load(path) as packed:
+            shape = tuple(packed["shape"])
+            bits = packed["bits"]
+        return np.unpackbits(bits, axis=-1, count=shape[-1]).astype(bool)
+    return np.load(path)
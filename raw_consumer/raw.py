@@ -1,16 +1,75 @@
 from pathlib import Path
+import numpy as np
 import xarray as xr
+import netCDF4
 import os
+import shutil
 import logging
 import functools
+import json
+import tempfile
+import time
+from contextlib import contextmanager
 from echolab2.instruments import EK80
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from scanner import plan_work, scan_raw
+from scheduler import memory_budget, run_scheduled
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 # Directory and logging setup
 input_dir = os.getenv("INPUT_DIR", "/data/sonar")
 output_dir = os.getenv("OUTPUT_DIR", "/data/processed")
 log = os.getenv("LOG_DIR", "log")
 
+# Number of pings decoded per window in streaming mode; 0 reads whole files
+window_pings = int(os.getenv("WINDOW_PINGS", 0))
+
+# Intermediate store: "netcdf" (.nc) or chunked, Zstd-compressed "zarr" (.zarr)
+intermediate_format = os.getenv("INTERMEDIATE_FORMAT", "netcdf").lower()
+chunk_pings = int(os.getenv("CHUNK_PINGS", 512))
+chunk_depth = int(os.getenv("CHUNK_DEPTH", 1024))
+zarr_clevel = int(os.getenv("ZARR_CLEVEL", 3))
+
+# Threads calibrating channels within one file; 0 shares MAX_WORKERS across the batch
+channel_workers = int(os.getenv("CHANNEL_WORKERS", 0))
+
+# Sv layout: "dense" NaN-padded frequency cube, or "ragged" with one group per channel
+sv_layout = os.getenv("SV_LAYOUT", "dense").lower()
+
+# On-disk Sv encoding: "float64", "float32" or dB-scaled "int16", with optional zlib
+sv_encoding = os.getenv("SV_ENCODING", "float64").lower()
+sv_complevel = int(os.getenv("SV_COMPLEVEL", 0))
+sv_shuffle = os.getenv("SV_SHUFFLE", "true").lower() == "true"
+
+# int16 packing covers -427.67..227.67 dB in steps of 0.01 dB
+INT16_SCALE = 0.01
+INT16_OFFSET = -100.0
+INT16_FILL = np.int16(-32768)
+
+# Scan datagram headers first to skip unusable files and order work by size
+scan_inputs = os.getenv("SCAN_INPUTS", "true").lower() == "true"
+
+# Truncated or undecodable files unchanged for this many seconds are taken to
+# be final: truncated ones are converted up to their last complete ping, the
+# others marked .failed. Younger ones may still be copied and wait.
+settle_seconds = float(os.getenv("SETTLE_SECONDS", 300))
+
+# Run the preprocessing stage in the conversion worker on the in-memory dataset,
+# writing echograms to IMAGE_DIR; the intermediate store becomes optional
+fuse_preprocessing = os.getenv("FUSE_PREPROCESSING", "false").lower() == "true"
+write_intermediate = os.getenv("WRITE_INTERMEDIATE", "true").lower() == "true"
+image_dir = os.getenv("IMAGE_DIR", "/data/test_imgs")
+
+# Also write a <stem>.ready sidecar once an output has been published
+completion_sidecar = os.getenv("COMPLETION_SIDECAR", "false").lower() == "true"
+
+# Files with more pings than this are split into ping-range shards; 0 disables
+shard_pings = int(os.getenv("SHARD_PINGS", 0))
+
+# Peak memory of a conversion as a multiple of the decoded sample size
+memory_factor = float(os.getenv("MEMORY_FACTOR", 3))
+
+SUFFIXES = {"netcdf": ".nc", "zarr": ".zarr"}
+
 logging.basicConfig(
     filename=Path(log) / "raw.log",
     level=logging.DEBUG,
@@ -32,14 +91,44 @@ def log_errors(func):
     return wrapper
 
 
+@contextmanager
+def window_file(fp: Path, header_end: int, first: int, end: int):
+    """
+    A temporary .raw file holding the header datagrams of `fp` followed by
+    bytes first..end, so a ping range is parsed without the datagrams before it.
+    """
+    with tempfile.NamedTemporaryFile(suffix=".raw") as tmp, open(fp, "rb") as src:
+        for lo, hi in ((0, header_end), (first, end)):
+            src.seek(lo)
+            while lo < hi:
+                chunk = src.read(min(hi - lo, 2**20))
+                if not chunk:
+                    break
+                tmp.write(chunk)
+                lo += len(chunk)
+        tmp.flush()
+        yield Path(tmp.name)
+
+
 @log_errors
-def read_raw(fp: Path):
+def read_raw(fp: Path, start_ping=None, end_ping=None, byte_range=None):
     echo = EK80.EK80()
 
     logging.info(f"Reading {fp}")
 
-    # Reading raw file
-    echo.read_raw(str(fp))
+    # Reading raw file, optionally restricted to a (1-based, inclusive) ping range.
+    # A raw file has no index: with start_ping the reader parses every datagram
+    # before the range, so callers that scanned the file pass the range's
+    # (header_end, first byte, end byte) instead.
+    if byte_range is not None:
+        logging.info(f"Reading pings {start_ping}-{end_ping} at bytes {byte_range}")
+        with window_file(fp, *byte_range) as window:
+            echo.read_raw(str(window))
+    elif start_ping is None and end_ping is None:
+        echo.read_raw(str(fp))
+    else:
+        logging.info(f"Reading pings {start_ping}-{end_ping}")
+        echo.read_raw(str(fp), start_ping=start_ping, end_ping=end_ping)
 
     # Reading bot file if it exists
     bot_fp = fp.with_suffix(".bot")
@@ -71,37 +160,58 @@ def sv_to_xarray(sv):
 
 
 @log_errors
-def generate_freq_sv_ds(fp: Path):
+def generate_freq_sv_ds(fp: Path, workers=1):
     ek80, data = read_raw(fp)
-    channel_da = []
-    bottom_da = []
+    return channels_to_ds(data, workers)
+
+
+@log_errors
+def generate_sv_store(fp: Path, workers=1, pings_at=None):
+    # `pings_at` restricts the read to a read_raw byte_range
+    ek80, data = read_raw(fp, byte_range=pings_at)
+    return channels_to_store(data, workers)
+
+
+def calibrate_channel(channel, channel_obj):
+    # Get Sv data and convert to xarray
+    sv = channel_obj.get_sv(return_depth=True)
+    xr_sv = sv_to_xarray(sv)
+
+    # Get bottom data if available
+    bot_da = None
+    try:
+        bottom = channel_obj.get_bottom(return_depth=True)
+        if bottom is not None and bottom.data.size > 0:
+            bot_da = xr.DataArray(
+                bottom.data,
+                coords=[sv.ping_time],
+                dims=["ping_time"],
+                name="bottom_depth",
+            )
+    except Exception as e:
+        logging.warning(f"No bottom data found for channel {channel}: {e}")
 
-    # Process each channel
+    return xr_sv, bot_da
+
+
+def calibrate_channels(data, workers=1):
+    channels = []
     for channel in data:
         print(channel, data[channel])
         if len(data[channel]) == 0:
             continue
+        channels.append((channel, data[channel][0]))
 
-        channel_obj = data[channel][0]
+    # Calibrate channels concurrently; the numpy work in get_sv releases the GIL
+    if workers > 1 and len(channels) > 1:
+        with ThreadPoolExecutor(max_workers=min(workers, len(channels))) as executor:
+            return list(executor.map(lambda c: calibrate_channel(*c), channels))
+    return [calibrate_channel(*c) for c in channels]
 
-        # Get Sv data and convert to xarray
-        sv = channel_obj.get_sv(return_depth=True)
-        xr_sv = sv_to_xarray(sv)
-        channel_da.append(xr_sv)
 
-        # Get bottom data if available
-        try:
-            bottom = channel_obj.get_bottom(return_depth=True)
-            if bottom is not None and bottom.data.size > 0:
-                bot_da = xr.DataArray(
-                    bottom.data,
-                    coords=[sv.ping_time],
-                    dims=["ping_time"],
-                    name="bottom_depth",
-                )
-                bottom_da.append(bot_da)
-        except Exception as e:
-            logging.warning(f"No bottom data found for channel {channel}: {e}")
+def merge_dense(results):
+    channel_da = [xr_sv for xr_sv, _ in results]
+    bottom_da = [bot_da for _, bot_da in results if bot_da is not None]
 
     # Concatenate the Sv data arrays across frequency dimension
     da = xr.concat(channel_da, dim="frequency")
@@ -116,17 +226,397 @@ def generate_freq_sv_ds(fp: Path):
     return ds
 
 
+def split_ragged(results):
+    """
+    Keep every channel on its native ping/depth grid, one group per channel.
+
+    The root group carries no data, only the `layout` attribute readers use
+    to tell this apart from the dense, NaN-padded frequency cube.
+    """
+    store = {None: xr.Dataset(attrs={"layout": "ragged"})}
+    for xr_sv, bot_da in results:
+        frequency = float(xr_sv.frequency[0])
+        ds = xr.Dataset({"Sv": xr_sv.isel(frequency=0, drop=True)})
+        if bot_da is not None:
+            ds["bottom_depth"] = bot_da
+        ds.attrs["frequency"] = frequency
+
+        group = str(int(frequency))
+        while group in store:  # Several transducers on one frequency
+            group += "_"
+        store[group] = ds
+    return store
+
+
+def channels_to_ds(data, workers=1):
+    results = calibrate_channels(data, workers)
+    if not results:
+        return None
+    return merge_dense(results)
+
+
+def channels_to_store(data, workers=1):
+    """
+    Calibrate all channels into a store: a dict of group name -> Dataset,
+    where the dense layout is a single Dataset in the root group (None).
+    """
+    results = calibrate_channels(data, workers)
+    if not results:
+        return None
+    if sv_layout == "ragged":
+        return split_ragged(results)
+    return {None: merge_dense(results)}
+
+
+def drop_seen(store, last_time):
+    """
+    Drop pings at or before the last ping time already written for each group,
+    in place, and return the number of new pings left in `store`.
+    """
+    n_pings = 0
+    for group, ds in store.items():
+        if "ping_time" not in ds.dims:
+            continue
+        ds = ds.assign_coords(ping_time=ds.ping_time.values.astype("datetime64[ns]"))
+        if group in last_time:
+            ds = ds.sel(ping_time=ds.ping_time > last_time[group])
+        if ds.sizes["ping_time"]:
+            last_time[group] = ds.ping_time.values[-1]
+        store[group] = ds
+        n_pings += ds.sizes["ping_time"]
+    return n_pings
+
+
+def align_to_grids(store, grids, source):
+    """
+    Reindex each group, in place, onto the frequency/depth grid it was first
+    written with, so later windows or parts can be appended to it.
+    """
+    for group, ds in store.items():
+        if "ping_time" not in ds.dims:
+            continue
+        fixed = {
+            dim: ds[dim].values for dim in ("frequency", "depth") if dim in ds.dims
+        }
+        if group not in grids:
+            grids[group] = fixed
+            continue
+        if any(len(fixed[dim]) != len(grids[group][dim]) for dim in fixed):
+            logging.warning(f"Channel or range layout changed within {source}")
+        store[group] = ds.reindex(grids[group])
+
+
+def ping_index(fp: Path, scan=None):
+    """
+    Function mapping a ping range of `fp` to the byte_range of read_raw, or
+    None when the file cannot be scanned. `fp` is only scanned when no `scan`
+    of it is given.
+    """
+    if scan is None:
+        try:
+            scan = scan_raw(fp)
+        except OSError as e:
+            logging.warning(
+                f"Could not index {fp}, reading windows by ping number: {e}"
+            )
+            return None
+    if len(scan.ping_ends) == 0:
+        return None
+    return lambda start, end: byte_range(scan, start, end)
+
+
+def byte_range(scan, start, end):
+    """read_raw byte_range of pings start..end of a scanned file, or None."""
+    pings = scan.byte_range(start, end)
+    return None if pings is None else (scan.header_end, *pings)
+
+
+def iter_sv_windows(fp: Path, window: int, workers=1, scan=None):
+    """
+    Yield Sv stores for consecutive windows of `window` pings.
+
+    Each window is decoded and calibrated from a fresh reader so that peak
+    memory depends on the window size, not on the length of the file. The
+    ping offsets come from `scan`, or from scanning the file once, so each
+    reader only parses its own window; without them every window re-parses
+    the file up to its start. Pings already yielded are dropped, so
+    overlapping ping ranges are harmless.
+    """
+    index = ping_index(fp, scan)
+    start = 1
+    last_time = {}
+    while True:
+        end = start + window - 1
+        byte_range = index(start, end) if index else None
+        if index and byte_range is None:
+            return
+        _, data = read_raw(fp, start_ping=start, end_ping=end, byte_range=byte_range)
+        store = channels_to_store(data, workers)
+        del data
+        if store is None or drop_seen(store, last_time) == 0:
+            return
+
+        yield store
+        start += window
+
+
+def append_netcdf(ds: xr.Dataset, path: Path, group=None):
+    """
+    Append `ds` along ping_time to the NetCDF file at `path`, creating it
+    (or the group) on first use.
+    """
+    exists = path.exists()
+    if exists and group is not None:
+        with netCDF4.Dataset(path) as nc:
+            exists = group in nc.groups
+
+    if not exists:
+        ds.to_netcdf(
+            path,
+            mode="a" if path.exists() else "w",
+            group=group,
+            unlimited_dims=["ping_time"],
+            encoding={
+                "ping_time": {
+                    "units": "microseconds since 1970-01-01",
+                    "dtype": "int64",
+                }
+            },
+        )
+        return
+
+    with netCDF4.Dataset(path, "a") as nc:
+        target = nc if group is None else nc.groups[group]
+        start = target.dimensions["ping_time"].size
+        stop = start + ds.sizes["ping_time"]
+        target["ping_time"][start:stop] = (
+            ds.ping_time.values - np.datetime64("1970-01-01")
+        ) // np.timedelta64(1, "us")
+
+        for name, da in ds.data_vars.items():
+            var = target[name]
+            index = tuple(
+                slice(start, stop) if dim == "ping_time" else slice(None)
+                for dim in var.dimensions
+            )
+            var[index] = np.ma.masked_invalid(da.transpose(*var.dimensions).values)
+
+
+def encode_sv(ds: xr.Dataset):
+    """
+    Attach the configured on-disk encoding to the Sv and bottom variables.
+
+    int16 stores Sv in dB (units="dB") packed with scale_factor/add_offset;
+    the other encodings keep linear Sv. NetCDF-only keys are dropped for Zarr.
+    """
+    if "Sv" not in ds:
+        return ds
+
+    encoding = {}
+    if sv_encoding == "int16":
+        lo = INT16_OFFSET + INT16_SCALE * -32767
+        hi = INT16_OFFSET + INT16_SCALE * 32767
+        with np.errstate(divide="ignore"):
+            sv_db = (10 * np.log10(ds.Sv)).clip(lo, hi)
+        ds = ds.assign(Sv=sv_db.assign_attrs(units="dB"))
+        encoding = {
+            "dtype": "int16",
+            "scale_factor": INT16_SCALE,
+            "add_offset": INT16_OFFSET,
+            "_FillValue": INT16_FILL,
+        }
+    elif sv_encoding == "float32":
+        encoding = {"dtype": "float32"}
+
+    if sv_complevel > 0:
+        encoding.update(zlib=True, complevel=sv_complevel, shuffle=sv_shuffle)
+
+    ds.Sv.encoding.update(encoding)
+    if "bottom_depth" in ds and sv_encoding != "float64":
+        ds["bottom_depth"].encoding["dtype"] = "float32"
+    return ds
+
+
+def zarr_encoding(ds: xr.Dataset):
+    """
+    Chunk every variable along ping_time/depth and compress it with Blosc/Zstd.
+    """
+    import numcodecs  # Only needed for Zarr output
+
+    compressor = numcodecs.Blosc(
+        cname="zstd", clevel=zarr_clevel, shuffle=numcodecs.Blosc.BITSHUFFLE
+    )
+    chunk_sizes = {"frequency": 1, "ping_time": chunk_pings, "depth": chunk_depth}
+    encoding = {}
+    for name, da in ds.data_vars.items():
+        chunks = tuple(
+            min(chunk_sizes.get(dim, size), size) or 1
+            for dim, size in zip(da.dims, da.shape)
+        )
+        # Keep the CF packing from encode_sv, Blosc replaces zlib/shuffle
+        cf = {
+            k: v
+            for k, v in da.encoding.items()
+            if k in ("dtype", "scale_factor", "add_offset", "_FillValue")
+        }
+        encoding[name] = {**cf, "compressor": compressor, "chunks": chunks}
+    return encoding
+
+
+def remove_output(path: Path):
+    if path.is_dir():
+        shutil.rmtree(path)
+    else:
+        path.unlink(missing_ok=True)
+
+
+@contextmanager
+def publish(path: Path):
+    """
+    Yield a staging path for `path` and rename it into place only once the
+    caller has finished writing, so consumers never see a partial output.
+    Staging lives in a hidden .tmp directory that consumers' globs skip.
+    """
+    staging = path.parent / ".tmp" / path.name
+    staging.parent.mkdir(parents=True, exist_ok=True)
+    remove_output(staging)
+    try:
+        yield staging
+    except BaseException:
+        remove_output(staging)
+        raise
+
+    remove_output(path)
+    os.replace(staging, path)
+    if completion_sidecar:
+        sidecar = path.with_suffix(".ready")
+        staging_sidecar = staging.with_suffix(".ready")
+        staging_sidecar.write_text(
+            json.dumps({"output": path.name, "published": time.time()})
+        )
+        os.replace(staging_sidecar, sidecar)
+    logging.debug(f"Published {path}")
+
+
+def write_group(ds: xr.Dataset, path: Path, group=None):
+    mode = "a" if path.exists() else "w"
+    if path.suffix == ".zarr":
+        ds.to_zarr(path, mode=mode, group=group, encoding=zarr_encoding(ds))
+    else:
+        ds.to_netcdf(path, mode=mode, group=group)
+
+
+def write_output(store, path: Path):
+    remove_output(path)
+    for group, ds in store.items():
+        write_group(encode_sv(ds), path, group)
+
+
+def append_output(store, path: Path):
+    for group, ds in store.items():
+        ds = encode_sv(ds)
+        if "ping_time" not in ds.dims:
+            if not path.exists():
+                write_group(ds, path, group)
+        elif path.suffix != ".zarr":
+            append_netcdf(ds, path, group)
+        elif (path / group if group else path).exists():
+            ds.to_zarr(path, group=group, append_dim="ping_time")
+        else:
+            write_group(ds, path, group)
+
+
+@log_errors
+def write_streaming(fp: Path, out_path: Path, window: int, workers=1, scan=None):
+    remove_output(out_path)
+    grids = {}
+    for store in iter_sv_windows(fp, window, workers, scan):
+        # The first window fixes the frequency and depth grid of each group
+        align_to_grids(store, grids, fp)
+        append_output(store, out_path)
+        logging.debug(f"Appended window to {out_path}")
+
+
+def shard_ranges(n_pings, shard):
+    """1-based, inclusive ping ranges of at most `shard` pings covering a file."""
+    return [
+        (start, min(start + shard - 1, n_pings))
+        for start in range(1, n_pings + 1, shard)
+    ]
+
+
+def part_path(output_dir: Path, file: Path, index: int):
+    # Parts live in a hidden directory so downstream globs never see them
+    return output_dir / ".parts" / file.stem / f"{index:04d}.nc"
+
+
+def read_store(path: Path):
+    root = xr.open_dataset(path).drop_encoding()
+    if root.attrs.get("layout") != "ragged":
+        return {None: root}
+    with netCDF4.Dataset(path) as nc:
+        groups = list(nc.groups)
+    store = {None: root}
+    for group in groups:
+        store[group] = xr.open_dataset(path, group=group).drop_encoding()
+    return store
+
+
+@log_errors
+def convert_shard(
+    file: Path, part: Path, start: int, end: int, workers=1, pings_at=None
+):
+    """
+    Decode pings start..end of `file` into an unencoded NetCDF part. `pings_at`
+    is their read_raw byte_range, when the file was scanned.
+    """
+    _, data = read_raw(file, start_ping=start, end_ping=end, byte_range=pings_at)
+    store = channels_to_store(data, workers)
+    del data
+    if store is None:
+        raise ValueError(f"No channel data in pings {start}-{end} of {file}")
+
+    part.parent.mkdir(parents=True, exist_ok=True)
+    remove_output(part)
+    for group, ds in store.items():
+        ds.to_netcdf(part, mode="a" if part.exists() else "w", group=group)
+
+
+@log_errors
+def merge_parts(file: Path, parts, out_path: Path):
+    """Append ordered parts into the final output one at a time, then drop them."""
+    grids = {}
+    last_time = {}
+    with publish(out_path) as staging:
+        for part in parts:
+            store = read_store(part)
+            opened = list(store.values())
+            if drop_seen(store, last_time):
+                align_to_grids(store, grids, file)
+                append_output(store, staging)
+            for ds in opened:
+                ds.close()
+
+    shutil.rmtree(parts[0].parent)
+    logging.info(f"Merged {len(parts)} parts of {file} into {out_path}")
+
+    if fuse_preprocessing:
+        render_images(out_path)
+
+
 def reduce_files_to_diff(inp, out):
     """
-    Find the difference between input files (.raw) and output files (.nc and .processed).
-    This ensures that files already processed (either .nc or .processed) are not reprocessed.
+    Find the difference between input files (.raw) and output files (.nc, .zarr, .processed and .failed).
+    This ensures that files already processed (either .nc/.zarr or a marker) are not reprocessed.
     """
     in_files = {f.stem for f in inp.glob("*.raw")}
 
     out_nc_files = {f.stem for f in out.glob("*.nc")}
+    out_zarr_files = {f.stem for f in out.glob("*.zarr")}
     out_processed_files = {f.stem for f in out.glob("*.processed")}
+    out_failed_files = {f.stem for f in out.glob("*.failed")}
 
-    out_files = out_nc_files | out_processed_files  # Union of both sets
+    out_files = out_nc_files | out_zarr_files | out_processed_files | out_failed_files
 
     # Find the difference (files in input but not in output)
     diff = in_files - out_files
@@ -137,35 +627,176 @@ def reduce_files_to_diff(inp, out):
 
 
 @log_errors
-def process_file(file: Path, output_dir: Path):
+def process_file(file: Path, output_dir: Path, workers=1, scan=None):
+    # `scan` is the ScanResult of plan_work, so workers don't scan files again
     try:
-        data = generate_freq_sv_ds(file)
-        data.to_netcdf((output_dir / file.stem).with_suffix(".nc"))
+        out_path = (output_dir / file.stem).with_suffix(SUFFIXES[intermediate_format])
+        store = None
+        if window_pings > 0:
+            with publish(out_path) as staging:
+                write_streaming(file, staging, window_pings, workers, scan)
+        else:
+            # Only the complete pings of a truncated file are decoded
+            pings_at = None
+            if scan is not None and scan.truncated:
+                pings_at = byte_range(scan, 1, scan.n_pings)
+            store = generate_sv_store(file, workers, pings_at)
+            if store is None:
+                raise ValueError(f"No channel data in {file}")
+            if write_intermediate or not fuse_preprocessing:
+                with publish(out_path) as staging:
+                    write_output(store, staging)
         logging.info(f"Successfully processed and saved {file}")
+
+        if fuse_preprocessing:
+            render_images(out_path, store)
     except Exception as e:
         logging.error(f"Error processing {file}: {e}")
 
 
+def render_images(out_path: Path, store=None):
+    """
+    Run the preprocessing stage on `store` in this worker, reading `out_path`
+    only when no in-memory store is given, and leave the same .processed or
+    .failed marker next to `out_path` that the preprocessing stage would.
+    """
+    import preprocessing
+
+    if preprocessing.sv_to_jpg(
+        out_path, estimate_bot=True, store=store, out_dir=image_dir
+    ):
+        preprocessing.mark_as_processed(out_path)
+    else:
+        preprocessing.mark_as_failed(out_path)
+
+
+def estimate_memory(file: Path, scan=None, shard=None):
+    """
+    Rough peak memory of converting `file` (or one ping shard of it), from the
+    scanned decode size when available, otherwise from the file size. Merging
+    holds one part at a time, so it costs about as much as a shard.
+    """
+    decoded = scan.estimated_bytes if scan is not None else 4 * file.stat().st_size
+    if shard == MERGE:
+        decoded = decoded * min(shard_pings, scan.n_pings) / max(scan.n_pings, 1)
+    elif shard is not None:
+        _, start, end = shard
+        decoded = decoded * (end - start + 1) / max(scan.n_pings, 1)
+    return int(memory_factor * decoded)
+
+
+# Work item shard of the merge that follows the last shard of a file
+MERGE = "merge"
+
+
+def plan_shards(plan):
+    """
+    Expand files with more than SHARD_PINGS pings into ping-range shards.
+    Returns work items (file, scan, shard), where shard is (index, start, end)
+    or None for a whole file. MERGE items are added once all shards are done.
+    """
+    items = []
+    for file, scan in plan:
+        if shard_pings > 0 and scan is not None and scan.n_pings > shard_pings:
+            for index, (start, end) in enumerate(
+                shard_ranges(scan.n_pings, shard_pings)
+            ):
+                items.append((file, scan, (index, start, end)))
+        else:
+            items.append((file, scan, None))
+    return items
+
+
 def consume_dir(input_dir: Path, output_dir: Path, max_workers=None):
     if max_workers is None:
         max_workers = int(os.getenv("MAX_WORKERS", os.cpu_count() or 4))
     files_to_compute = list(reduce_files_to_diff(input_dir, output_dir))
 
-    logging.info(f"Starting to process {len(files_to_compute)} files in parallel.")
+    def reject(file, reason):
+        # Mark files that can never be converted, so they are not rescanned
+        (output_dir / file.stem).with_suffix(".failed").touch()
+        logging.error(f"Marked {file} as failed: {reason}")
 
-    # Process files in parallel using ProcessPoolExecutor
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        future_to_file = {
-            executor.submit(process_file, file, output_dir): file
-            for file in files_to_compute
-        }
+    if scan_inputs:
+        plan = plan_work(files_to_compute, settle_seconds, reject)
+    else:
+        plan = [(fp, None) for fp in files_to_compute]
+    items = plan_shards(plan)
 
-        for future in as_completed(future_to_file):
-            file = future_to_file[future]
+    # Hand cores left idle by a small batch to the channels inside each file
+    workers = channel_workers or max(1, max_workers // max(len(items), 1))
+    budget = memory_budget()
+
+    logging.info(
+        f"Starting to process {len(plan)} files as {len(items)} work items in parallel "
+        f"with {workers} channel workers each and a {budget / 2**30:.1f} GiB memory budget."
+    )
+
+    def out_path(file):
+        return (output_dir / file.stem).with_suffix(SUFFIXES[intermediate_format])
+
+    def submit(item):
+        file, scan, shard = item
+        if shard is None:
+            return executor.submit(process_file, file, output_dir, workers, scan)
+        if shard == MERGE:
+            n_shards = len(shard_ranges(scan.n_pings, shard_pings))
+            parts = [part_path(output_dir, file, i) for i in range(n_shards)]
+            return executor.submit(merge_parts, file, parts, out_path(file))
+        index, start, end = shard
+        part = part_path(output_dir, file, index)
+        pings_at = byte_range(scan, start, end)
+        return executor.submit(convert_shard, file, part, start, end, workers, pings_at)
+
+    # Shards still running, and files with a failed shard
+    remaining = {}
+    failed = set()
+    for file, _, shard in items:
+        if shard is not None:
+            remaining[file] = remaining.get(file, 0) + 1
+
+    def give_up(file):
+        # Drop the finished parts and mark the file, so it is not decoded again
+        shutil.rmtree(output_dir / ".parts" / file.stem, ignore_errors=True)
+        out_path(file).with_suffix(".failed").touch()
+        logging.error(f"Marked {file} as failed")
+
+    def follow_up(item, future):
+        # Merge a file through the memory budget once all its shards are done
+        file, scan, shard = item
+        if shard is None:
+            return []
+        if future.exception() is not None:
+            failed.add(file)
+        if shard == MERGE:
+            if file in failed:
+                give_up(file)
+            return []
+        remaining[file] -= 1
+        if remaining[file] > 0:
+            return []
+        if file in failed:
+            give_up(file)
+            return []
+        return [(file, scan, MERGE)]
+
+    # Process files in parallel, admitting them against the memory budget
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        scheduled = run_scheduled(
+            items,
+            submit,
+            lambda item: estimate_memory(*item),
+            budget,
+            max_workers,
+            follow_up,
+        )
+
+        for (file, _, shard), future in scheduled:
             try:
                 future.result()  # This will raise an exception if one occurred during processing
             except Exception as e:
-                logging.error(f"Error processing file {file}: {e}")
+                step = "merging parts of" if shard == MERGE else "processing file"
+                logging.error(f"Error {step} {file}: {e}")
 
     logging.info("Finished processing files in parallel.")
 
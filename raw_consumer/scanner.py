@@ -0,0 +1,203 @@
+"""
+Lightweight scanner for Simrad EK80 .raw files.
+
+Walks the datagram headers only (length, type, timestamp and the fixed part
+of RAW3 sample datagrams) and seeks over the payloads, so a multi-GB file is
+characterised in a fraction of the time a full `read_raw` takes. The result is
+used to skip unusable files and to order work by estimated decode cost.
+
+A file cut off mid-datagram is either still being copied or was truncated for
+good (a crashed echosounder, a partial transfer); once it has stopped changing,
+its complete pings are converted on their own.
+"""
+
+from dataclasses import dataclass, field
+from pathlib import Path
+import logging
+import os
+import struct
+import time
+
+import numpy as np
+
+# Every datagram is framed as <int32 length><header + body><int32 length>
+LENGTH = struct.Struct("<l")
+# Header: type, NT time (low, high)
+HEADER = struct.Struct("<4sLL")
+# Fixed part of a RAW3 body: channel id, data type, spare, offset, count
+RAW3 = struct.Struct("<128sH2sll")
+
+# Sanity bound for a single datagram; anything larger is treated as corruption
+MAX_DATAGRAM = 64 * 1024 * 1024
+
+NT_EPOCH = np.datetime64("1601-01-01T00:00:00", "ns")
+
+
+@dataclass
+class ScanResult:
+    path: Path
+    pings: dict = field(default_factory=dict)  # channel id -> ping count
+    samples: int = 0
+    estimated_bytes: int = 0
+    start_time: np.datetime64 = None
+    end_time: np.datetime64 = None
+    n_datagrams: int = 0
+    truncated: bool = False
+    error: str = None
+    # Byte offset of the first RAW3 datagram; everything before it (configuration,
+    # filters, environment) is needed to decode any ping
+    header_end: int = 0
+    # Byte offset just past the last RAW3 datagram of every ping
+    ping_ends: list = field(default_factory=list)
+
+    @property
+    def channels(self):
+        return list(self.pings)
+
+    @property
+    def n_pings(self):
+        return len(self.ping_ends) or max(self.pings.values(), default=0)
+
+    def byte_range(self, start, end):
+        """
+        (first byte, end byte) of the datagrams of pings start..end (1-based,
+        inclusive), or None past the last ping.
+        """
+        if start > len(self.ping_ends):
+            return None
+        first = self.header_end if start == 1 else int(self.ping_ends[start - 2])
+        return first, int(self.ping_ends[min(end, len(self.ping_ends)) - 1])
+
+    @property
+    def usable(self):
+        # A truncated file is usable up to its last complete ping
+        return self.error is None and self.n_pings > 0
+
+
+def nt_time(low, high):
+    return NT_EPOCH + np.timedelta64(((high << 32) | low) * 100, "ns")
+
+
+def sample_bytes(data_type):
+    """Rough in-memory cost of one decoded sample for a RAW3 data type."""
+    n_complex = (data_type >> 8) & 0x7
+    size = 8  # calibrated Sv, float64
+    if data_type & 0x1:
+        size += 8  # power
+    if data_type & 0x2:
+        size += 2  # split-beam angles
+    if data_type & 0xC:
+        size += 8 * max(n_complex, 1)  # complex64 per transducer sector
+    return size
+
+
+def scan_raw(fp: Path) -> ScanResult:
+    result = ScanResult(path=Path(fp))
+
+    with open(fp, "rb") as f:
+        file_size = f.seek(0, 2)
+        f.seek(0)
+        pos = 0
+        ping = set()  # Channels seen in the current ping
+
+        while pos < file_size:
+            if file_size - pos < LENGTH.size + HEADER.size:
+                result.truncated = True
+                break
+
+            (length,) = LENGTH.unpack(f.read(LENGTH.size))
+            if length < HEADER.size or length > MAX_DATAGRAM:
+                result.error = f"invalid datagram length {length} at byte {pos}"
+                break
+
+            end = pos + LENGTH.size + length + LENGTH.size
+            if end > file_size:
+                result.truncated = True
+                break
+
+            dg_type, low, high = HEADER.unpack(f.read(HEADER.size))
+            if not dg_type.isalnum():
+                result.error = f"invalid datagram type {dg_type!r} at byte {pos}"
+                break
+
+            if dg_type == b"RAW3" and length >= HEADER.size + RAW3.size:
+                channel, data_type, _, _, count = RAW3.unpack(f.read(RAW3.size))
+                channel = channel.rstrip(b"\x00").decode("latin-1").strip()
+                result.pings[channel] = result.pings.get(channel, 0) + 1
+
+                # A channel sampling again starts the next ping
+                if not ping:
+                    result.header_end = pos
+                elif channel in ping:
+                    result.ping_ends.append(last_raw3)
+                    ping.clear()
+                ping.add(channel)
+                last_raw3 = end
+                result.samples += count
+                result.estimated_bytes += count * sample_bytes(data_type)
+
+                time = nt_time(low, high)
+                if result.start_time is None:
+                    result.start_time = time
+                result.end_time = time
+
+            f.seek(end - LENGTH.size)
+            (trailer,) = LENGTH.unpack(f.read(LENGTH.size))
+            if trailer != length:
+                result.error = f"length mismatch ({length} != {trailer}) at byte {pos}"
+                break
+
+            result.n_datagrams += 1
+            pos = end
+
+    # A ping cut short by truncation is left out
+    if ping and not (result.truncated and len(ping) < len(result.pings)):
+        result.ping_ends.append(last_raw3)
+    result.ping_ends = np.asarray(result.ping_ends, dtype=np.int64)
+    return result
+
+
+def plan_work(files, settle=0, reject=None):
+    """
+    Scan `files`, drop the ones that cannot be decoded and order the rest
+    largest-first, so the longest conversions start early and no single big
+    file is left running alone at the end of a batch.
+
+    Truncated or undecodable files modified less than `settle` seconds ago may
+    still be copied and are left for a later pass. Older truncated files are
+    planned with their complete pings; older undecodable ones are passed to
+    `reject(fp, reason)`, so they can be marked instead of rescanned forever.
+    """
+    plan = []
+    for fp in files:
+        try:
+            scan = scan_raw(fp)
+            age = time.time() - os.stat(fp).st_mtime
+        except OSError as e:
+            logging.warning(f"Could not scan {fp}: {e}")
+            continue
+
+        if (scan.truncated or not scan.usable) and age < settle:
+            logging.info(f"Deferring {fp}: modified {age:.0f} s ago, may be copying")
+            continue
+
+        if not scan.usable:
+            reason = scan.error or ("truncated" if scan.truncated else "no pings")
+            logging.warning(f"Skipping {fp}: {reason}")
+            if reject is not None:
+                reject(fp, reason)
+            continue
+
+        if scan.truncated:
+            logging.warning(
+                f"{fp} is truncated, converting its {scan.n_pings} complete pings"
+            )
+
+        logging.debug(
+            f"Scanned {fp}: {scan.n_pings} pings on {len(scan.pings)} channels, "
+            f"~{scan.estimated_bytes / 2**20:.0f} MiB to decode"
+        )
+        plan.append((fp, scan))
+
+    plan.sort(key=lambda item: item[1].estimated_bytes, reverse=True)
+    return plan
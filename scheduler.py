@@ -0,0 +1,101 @@
+"""
+Memory-aware admission of work into a process pool.
+
+Both conversion and preprocessing used to submit every pending file at once,
+which lets a handful of large files decode together and OOM the container.
+Here every item carries an estimated peak memory, items are started
+largest-first and only while their estimates fit in a memory budget. The
+budget comes from MEMORY_BUDGET, or from the container's cgroup limit.
+"""
+
+from concurrent.futures import FIRST_COMPLETED, wait
+from pathlib import Path
+import logging
+import os
+
+UNITS = {"k": 2**10, "m": 2**20, "g": 2**30, "t": 2**40}
+
+# cgroup v1 reports "no limit" as a huge page-aligned number
+UNLIMITED = 2**60
+
+
+def parse_bytes(text):
+    """Parse sizes such as "4096", "512M" or "8GiB" into bytes."""
+    text = str(text).strip().lower().removesuffix("ib").removesuffix("b")
+    if text and text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(float(text))
+
+
+def cgroup_limit(root="/sys/fs/cgroup"):
+    """Memory limit of the current cgroup (v2 or v1), or None when unlimited."""
+    root = Path(root)
+    for path in (root / "memory.max", root / "memory" / "memory.limit_in_bytes"):
+        try:
+            value = path.read_text().strip()
+        except OSError:
+            continue
+        if value == "max" or int(value) >= UNLIMITED:
+            return None
+        return int(value)
+    return None
+
+
+def memory_budget(cgroup_root="/sys/fs/cgroup"):
+    """
+    Bytes available to running work. An explicit MEMORY_BUDGET is used as is;
+    otherwise MEMORY_FRACTION of the cgroup limit (or of physical memory)
+    leaves headroom for the parent process and the page cache.
+    """
+    configured = os.getenv("MEMORY_BUDGET")
+    if configured:
+        return parse_bytes(configured)
+
+    limit = cgroup_limit(cgroup_root)
+    if limit is None:
+        limit = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    return int(limit * float(os.getenv("MEMORY_FRACTION", 0.8)))
+
+
+def run_scheduled(items, submit, estimate, budget, max_concurrent, follow_up=None):
+    """
+    Start `submit(item)` for every item, largest estimate first, while the
+    estimates of the running items fit in `budget`. Smaller items backfill
+    when the next large one does not fit. An item larger than the whole
+    budget still runs, alone.
+
+    `follow_up(item, future)`, if given, is called as each item completes and
+    returns further items to admit against the same budget (e.g. merging the
+    parts of a file once its last part is done).
+
+    Yields (item, future) pairs as they complete.
+    """
+    pending = sorted(((estimate(item), item) for item in items), key=lambda p: -p[0])
+    running = {}
+    in_use = 0
+
+    while pending or running:
+        i = 0
+        while i < len(pending) and len(running) < max_concurrent:
+            cost, item = pending[i]
+            cost = min(cost, budget)
+            if running and in_use + cost > budget:
+                i += 1
+                continue
+
+            pending.pop(i)
+            running[submit(item)] = (item, cost)
+            in_use += cost
+            logging.debug(
+                f"Admitted {item} (~{cost / 2**20:.0f} MiB, "
+                f"{in_use / 2**20:.0f}/{budget / 2**20:.0f} MiB in use)"
+            )
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            item, cost = running.pop(future)
+            in_use -= cost
+            if follow_up is not None:
+                pending.extend((estimate(new), new) for new in follow_up(item, future))
+                pending.sort(key=lambda p: -p[0])
+            yield item, future
@@ -7,6 +7,7 @@ import xarray as xr
 
 # Make module imports work without installing packages
 ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
 sys.path.insert(0, str(ROOT / "inference"))
 sys.path.insert(0, str(ROOT / "preprocessing"))
 sys.path.insert(0, str(ROOT / "raw_consumer"))
@@ -0,0 +1,87 @@
+import os
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+import xarray as xr
+from PIL import Image
+
+os.environ.setdefault("LOG_DIR", ".")
+
+import binning
+import preprocessing as pp
+
+
+def make_sv(n_pings=23, n_depths=17, seed=0):
+    rng = np.random.default_rng(seed)
+    sv = 10 ** (rng.uniform(-80, -30, size=(n_pings, n_depths)) / 10)
+    ping_time = np.datetime64("2024-01-01", "ns") + np.arange(n_pings).astype(
+        "timedelta64[s]"
+    )
+    depth = np.linspace(0, 100, n_depths)
+    return xr.DataArray(
+        sv, coords={"ping_time": ping_time, "depth": depth}, dims=["ping_time", "depth"]
+    )
+
+
+def loop_mean(a, ping_bin, depth_bin):
+    rows = range(0, a.shape[0], ping_bin)
+    cols = range(0, a.shape[1], depth_bin)
+    return np.array(
+        [[a[i : i + ping_bin, j : j + depth_bin].mean() for j in cols] for i in rows]
+    )
+
+
+@pytest.mark.parametrize("bins", [(1, 1), (2, 3), (5, 4), (23, 17), (30, 1)])
+def test_block_mean_matches_loops(bins):
+    a = make_sv().values
+    np.testing.assert_allclose(binning.block_mean(a, *bins), loop_mean(a, *bins))
+
+
+def test_block_mean_propagates_nan():
+    a = make_sv().values
+    a[3, 15] = np.nan
+    result = binning.block_mean(a, 4, 4)
+    assert np.isnan(result[0, 3])
+    assert np.isnan(result).sum() == 1
+
+
+def test_downsample_averages_linear_sv():
+    """dB input is averaged as linear Sv, not as dB."""
+    sv = make_sv()
+    db = 10 * np.log10(sv)
+    db.attrs["units"] = "dB"
+
+    linear, _ = binning.downsample(sv, ping_bin=4, depth_bin=3)
+    from_db, _ = binning.downsample(db, ping_bin=4, depth_bin=3, linear=False)
+
+    np.testing.assert_allclose(linear.values, loop_mean(sv.values, 4, 3))
+    np.testing.assert_allclose(from_db.values, 10 * np.log10(linear.values))
+    assert from_db.attrs["units"] == "dB"
+    assert linear.shape == (6, 6)
+    np.testing.assert_allclose(
+        linear.depth.values, loop_mean(sv.depth.values[None], 1, 3)[0]
+    )
+    assert (linear.ping_time.values == sv.ping_time.values[::4]).all()
+
+
+def test_downsample_bottom():
+    sv = make_sv()
+    bottom = np.linspace(50, 72, sv.sizes["ping_time"])
+    bottom[:4] = np.nan
+    bottom[5] = np.nan
+
+    _, binned = binning.downsample(sv, bottom, ping_bin=4)
+
+    assert np.isnan(binned.values[0])
+    assert binned.values[1] == pytest.approx(np.nanmean(bottom[4:8]))
+    assert binned.values[-1] == pytest.approx(bottom[20:].mean())
+
+
+def test_sv_to_jpg_binned(synthetic_nc, tmp_path):
+    """PING_BIN / DEPTH_BIN shrink the echogram by the bin sizes."""
+    with patch.object(pp, "ping_bin", 5), patch.object(pp, "depth_bin", 4):
+        assert pp.sv_to_jpg(synthetic_nc, out_dir=tmp_path)
+
+    # 50 pings x 100 depths
+    assert Image.open(tmp_path / "test_sample" / "38000.png").size == (10, 25)
@@ -0,0 +1,110 @@
+import json
+import os
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+import xarray as xr
+from PIL import Image
+
+os.environ.setdefault("LOG_DIR", ".")
+
+import composite
+import preprocessing as pp
+
+
+def test_parse_freqs():
+    assert composite.parse_freqs("") == ()
+    assert composite.parse_freqs("38000, 120000,200000") == (38000, 120000, 200000)
+    with pytest.raises(ValueError):
+        composite.parse_freqs("38000,120000")
+
+
+def make_layer(depth, n_pings=12, first_ping=0, bottom=None):
+    """Linear Sv whose dB value encodes the depth, -80 dB at 0 m to -30 at 100 m."""
+    ping_time = np.datetime64("2024-01-01", "ns") + np.arange(
+        first_ping, first_ping + n_pings
+    ).astype("timedelta64[s]")
+    db = np.broadcast_to(-80 + depth / 2, (n_pings, depth.size))
+    sv = xr.DataArray(
+        10 ** (db / 10),
+        coords={"ping_time": ping_time, "depth": depth},
+        dims=["ping_time", "depth"],
+    )
+    return sv, bottom, True
+
+
+def test_render_aligns_channels_by_depth():
+    """Every pixel row shows the same depth in R, G and B."""
+    layers = [
+        make_layer(np.arange(0, 101, 2.0)),
+        make_layer(np.arange(0, 201, 1.0), first_ping=3),
+        make_layer(np.arange(10, 60.5, 0.5), n_pings=20),
+    ]
+    rgb = composite.render(layers)
+
+    # Pings 3..11 are held by all three; depths 10..60 m on the 2 m grid
+    assert rgb.shape == (26, 9, 3)
+    assert (rgb[..., 0] == rgb[..., 1]).all() and (rgb[..., 0] == rgb[..., 2]).all()
+    expected = np.arange(10, 61, 2) / 2 * 5.1
+    np.testing.assert_allclose(rgb[:, 0, 0], expected, atol=1)
+
+
+def test_render_bottoms():
+    """Pings without a bottom drop out; samples below a bottom are blanked."""
+    bottom = np.full(12, 40.0)
+    bottom[2] = np.nan
+    bottom[5] = 30.0
+    layers = [
+        make_layer(np.arange(0, 101, 1.0), bottom=bottom),
+        make_layer(np.arange(0, 101, 1.0)),
+        make_layer(np.arange(0, 101, 1.0)),
+    ]
+    rgb = composite.render(layers, offset=3, min_depth=25)
+
+    # 25..43 m over the 11 pings with a bottom; ping 5 is column 4
+    assert rgb.shape == (19, 11, 3)
+    assert (rgb[34 - 25 :, 4, 0] == 0).all()
+    assert (rgb[: 34 - 25, 4, 0] > 0).all()
+    assert (rgb[34 - 25 :, 4, 1] > 0).all()
+
+
+def test_render_without_shared_grid():
+    deep = make_layer(np.arange(0, 100.0))
+    layers = [make_layer(np.arange(0, 50.0)), make_layer(np.arange(60, 100.0)), deep]
+    assert composite.render(layers) is None
+
+    later = make_layer(np.arange(0, 100.0), first_ping=100)
+    assert composite.render([later, deep, deep]) is None
+
+
+def test_sv_to_jpg_composite(synthetic_nc, tmp_path):
+    """The composite holds one channel per requested frequency."""
+    with patch.object(pp, "composite_freqs", (38000, 70000, 38000)):
+        assert pp.sv_to_jpg(synthetic_nc, estimate_bot=True, out_dir=tmp_path)
+
+    rgb = np.asarray(Image.open(tmp_path / "test_sample" / "composite.png"))
+    assert rgb.ndim == 3 and rgb.shape[-1] == 3
+    np.testing.assert_array_equal(rgb[..., 0], rgb[..., 2])
+    assert rgb[..., 0].any() and rgb[..., 1].any()
+
+
+def test_composite_tensor_shard(synthetic_nc, tmp_path):
+    """With a composite the shard holds just the composite entry."""
+    with patch.object(pp, "composite_freqs", (38000, 70000, 38000)), patch.object(
+        pp, "write_png", False
+    ), patch.object(pp, "write_tensors", True), patch.object(pp, "tensor_size", 32):
+        assert pp.sv_to_jpg(synthetic_nc, out_dir=tmp_path)
+
+    sample = tmp_path / "test_sample"
+    index = json.loads((sample / "index.json").read_text())
+    assert [e["name"] for e in index["entries"]] == ["composite"]
+    assert np.load(sample / "tensors.npy").shape == (1, 32, 32, 3)
+
+
+def test_composite_missing_frequency(synthetic_nc, tmp_path):
+    with patch.object(pp, "composite_freqs", (38000, 70000, 200000)):
+        assert pp.sv_to_jpg(synthetic_nc, out_dir=tmp_path)
+
+    assert not (tmp_path / "test_sample" / "composite.png").exists()
+    assert (tmp_path / "test_sample" / "38000.png").exists()
@@ -0,0 +1,66 @@
+import os
+import sys
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+from PIL import Image
+
+os.environ.setdefault("LOG_DIR", ".")
+
+import debug_artifacts
+import preprocessing as pp
+
+
+def test_wanted_modes():
+    stems = [f"D2024{i:04d}" for i in range(400)]
+    assert not any(debug_artifacts.wanted(s, "off") for s in stems)
+    assert all(debug_artifacts.wanted(s, "fast") for s in stems)
+
+    sampled = [s for s in stems if debug_artifacts.wanted(s, "sampled", every=10)]
+    assert 10 < len(sampled) < 80
+    # The same files are picked on every run
+    assert sampled == [s for s in stems if debug_artifacts.wanted(s, "sampled", 10)]
+
+
+def test_thumbnail_is_bounded():
+    sv = 10 ** (np.random.default_rng(0).uniform(-80, -30, size=(5000, 3000)) / 10)
+    img = debug_artifacts.thumbnail(sv, np.linspace(0, 500, 3000), size=(400, 200))
+    assert img.width <= 400 and img.height <= 200
+    assert img.mode == "L"
+
+
+@pytest.mark.parametrize(
+    "mode, expected", [("off", 0), ("fast", 3)]  # 1 echogram + 2 frequencies
+)
+def test_sv_to_jpg_debug_modes(mode, expected, synthetic_nc, tmp_path):
+    out, logs = tmp_path / "output", tmp_path / "log"
+    logs.mkdir()
+
+    with patch.object(pp, "output_dir", str(out)), patch.object(
+        pp, "log_path", str(logs)
+    ), patch.object(pp, "debug_mode", mode):
+        assert pp.sv_to_jpg(synthetic_nc, estimate_bot=True)
+
+    debug = list(tmp_path.rglob("*_debug.jpg"))
+    assert len(debug) == expected
+    for path in debug:
+        assert Image.open(path).format == "JPEG"
+
+
+def test_matplotlib_only_when_sampled(synthetic_nc, tmp_path):
+    """Production runs never import matplotlib."""
+    with patch.dict(sys.modules, {"matplotlib.pyplot": None}), patch.object(
+        pp, "log_path", str(tmp_path)
+    ), patch.object(pp, "debug_mode", "fast"):
+        assert pp.sv_to_jpg(synthetic_nc, estimate_bot=True, out_dir=tmp_path)
+
+
+def test_sampled_files_get_figures(synthetic_nc, tmp_path):
+    with patch.object(pp, "log_path", str(tmp_path)), patch.object(
+        pp, "debug_mode", "sampled"
+    ), patch.object(debug_artifacts, "wanted", return_value=True):
+        assert pp.sv_to_jpg(synthetic_nc, estimate_bot=True, out_dir=tmp_path)
+
+    figure = Image.open(tmp_path / "test_sample_debug.jpg")
+    assert figure.size == (640, 480)  # matplotlib's default figure
@@ -0,0 +1,114 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+import echogram
+
+
+def make_channel(n_pings=40, n_depths=60, dtype=np.float64, seed=0):
+    rng = np.random.default_rng(seed)
+    depth = np.linspace(0, 120, n_depths)
+    ping_time = np.datetime64("2024-01-01", "ns") + np.arange(n_pings).astype(
+        "timedelta64[s]"
+    )
+    sv = (10 ** (rng.uniform(-95, -15, size=(n_pings, n_depths)) / 10)).astype(dtype)
+    sv[:, -5:] = np.nan  # NaN padding of a shorter channel in the dense cube
+    sv[3, 7] = np.nan  # and a stray gap, which drops that depth row
+    bottom = rng.uniform(60, 90, size=n_pings)
+    bottom[[0, 11]] = np.nan
+    bottom[5] = 10.0  # bottom above every depth kept, the ping drops out
+
+    sv = xr.DataArray(
+        sv, coords={"ping_time": ping_time, "depth": depth}, dims=["ping_time", "depth"]
+    )
+    bottom = xr.DataArray(bottom, coords={"ping_time": ping_time}, dims=["ping_time"])
+    return sv, bottom
+
+
+def reference(sv, bottom=None, vmin=-80, vmax=-30, offset=3):
+    """
+    The xarray chain sv_to_jpg used before the vectorized engine, quantizing
+    in matplotlib's Normalize order.
+    """
+    sv = 10 * np.log10(sv.dropna(dim="depth"))
+    mask = None
+    if bottom is not None:
+        bottom = bottom.dropna(dim="ping_time")
+        sv = sv.where(sv.depth <= bottom + offset, drop=True)
+        sv = sv.where(sv.depth >= 25, drop=True)
+        mask = np.asarray((sv.depth <= bottom + offset) & (sv.depth >= 25))
+    levels = (np.clip(np.array(sv.data), vmin, vmax) - vmin) / (vmax - vmin) * 255
+    image = np.nan_to_num(levels).T.astype(np.uint8)
+    return image, mask
+
+
+def assert_levels_match(image, expected):
+    """The fused affine map may round a value sitting on a level boundary down."""
+    assert image.shape == expected.shape
+    diff = np.abs(image.astype(int) - expected)
+    assert diff.max() <= 1
+    assert (diff == 0).mean() > 0.99
+
+
+@pytest.mark.parametrize("block_pings", [1, 7, 1024])
+def test_render_matches_xarray_with_bottom(block_pings):
+    """Crop, blanking below the bottom and quantization match the xarray chain."""
+    sv, bottom = make_channel()
+    expected, expected_mask = reference(sv, bottom)
+
+    image, mask = echogram.render(
+        sv, sv.depth.values, bottom.values, block_pings=block_pings
+    )
+
+    assert image.dtype == np.uint8
+    assert_levels_match(image, expected)
+    np.testing.assert_array_equal(mask, expected_mask)
+    assert not image[~mask].any()
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_render_matches_xarray_without_bottom(dtype):
+    """Without a bottom every depth row without NaN is quantized."""
+    sv, _ = make_channel(dtype=dtype)
+    expected, _ = reference(sv)
+
+    image, mask = echogram.render(sv.values, sv.depth.values, block_pings=16)
+
+    assert_levels_match(image, expected)
+    assert mask is None
+
+
+def test_render_db_input():
+    """Sv packed in dB by the conversion stage skips the log transform."""
+    sv, bottom = make_channel()
+    expected, _ = reference(sv, bottom)
+
+    with np.errstate(divide="ignore"):
+        sv_db = 10 * np.log10(sv)
+    image, _ = echogram.render(sv_db, sv.depth.values, bottom.values, linear=False)
+
+    assert_levels_match(image, expected)
+
+
+def test_render_nothing_to_draw():
+    sv, bottom = make_channel()
+    assert echogram.render(sv * np.nan, sv.depth.values) == (None, None)
+    assert echogram.render(sv, sv.depth.values, bottom * np.nan) == (None, None)
+
+
+def test_quantize_levels():
+    """vmin and below map to 0, vmax and above to 255, NaN to 0."""
+    scale, shift = echogram.affine(-80, -30)
+    buf = np.array([-100, -80, -55, -30, 0, np.nan]) * scale
+    out = np.empty(buf.shape, dtype=np.uint8)
+    echogram.quantize(buf, shift, out)
+    np.testing.assert_array_equal(out, [0, 0, 127, 255, 255, 0])
+
+
+def test_apply_colormap():
+    """Colormap LUTs expand grey levels to RGB with the colormap's endpoints."""
+    image = np.array([[0, 255]], dtype=np.uint8)
+    rgb = echogram.apply_colormap(image, "viridis")
+    assert rgb.shape == (1, 2, 3) and rgb.dtype == np.uint8
+    np.testing.assert_array_equal(rgb[0, 0], [68, 1, 84])
+    assert echogram.colormap_lut("viridis") is echogram.colormap_lut("viridis")
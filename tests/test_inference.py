@@ -1,7 +1,10 @@
+import json
 from pathlib import Path
 
+import numpy as np
 import pytest
 import torch
+from PIL import Image
 
 # Ensure inference/ is on path (conftest.py handles this)
 import inspect_attention as ia
@@ -121,3 +124,264 @@ def test_reduce_files_to_diff(tmp_path):
     stems = {p.stem for p in result}
     assert "sample2" in stems
     assert "sample1" not in stems
+
+
+def test_reduce_files_to_diff_skips_staging(tmp_path):
+    """Hidden staging folders from preprocessing must not be treated as samples."""
+    inp = tmp_path / "input"
+    out = tmp_path / "output"
+    (inp / ".tmp" / "sample1").mkdir(parents=True)
+    (inp / ".tmp" / "sample1" / "38000.png").touch()
+    out.mkdir()
+
+    assert ia.reduce_files_to_diff(inp, out) == []
+
+
+def test_shard_batch_matches_png_path(synthetic_png, tmp_path):
+    """Tensor shard entries give the same input tensor as the PNG they replace."""
+    image_size = (64, 64)
+    resized = Image.open(synthetic_png).resize(image_size[::-1], Image.BILINEAR)
+    np.save(tmp_path / "tensors.npy", np.asarray(resized)[None, ..., None])
+    (tmp_path / "index.json").write_text(
+        json.dumps({"shape": [1, 64, 64, 1], "entries": [{"name": "38000"}]})
+    )
+
+    tensors, names = ia.read_shard(tmp_path)
+    batch = ia.load_batch([(tensors, 0)], image_size, torch.device("cpu"))
+
+    assert names == ["38000"]
+    assert isinstance(tensors, np.memmap)
+    expected = ia.process_image(synthetic_png, image_size)
+    torch.testing.assert_close(batch[0], expected)
+    assert ia.preview((tensors, 0)).size == (64, 64)
+
+
+def test_gather_slices_consecutive_entries(tmp_path):
+    """Consecutive shard entries are batched straight from the memory map."""
+    data = np.arange(4 * 8 * 8 * 3, dtype=np.uint8).reshape(4, 8, 8, 3)
+    np.save(tmp_path / "tensors.npy", data)
+    (tmp_path / "index.json").write_text(
+        json.dumps({"shape": list(data.shape), "entries": [{"name": "a"}] * 4})
+    )
+    tensors, _ = ia.read_shard(tmp_path)
+
+    run = ia.gather([(tensors, 1), (tensors, 2), (tensors, 3)])
+    assert np.shares_memory(run, tensors)
+    np.testing.assert_array_equal(run, data[1:])
+
+    picks = ia.gather([(tensors, 0), (tensors, 2)])
+    assert not np.shares_memory(picks, tensors)
+    np.testing.assert_array_equal(picks, data[[0, 2]])
+
+    batch = ia.load_batch([(tensors, 1), (tensors, 2)], (8, 8), torch.device("cpu"))
+    expected = ia.shard_batch(data[1:3].copy(), (8, 8), torch.device("cpu"))
+    torch.testing.assert_close(batch, expected)
+
+
+def test_read_shard_png_sample(tmp_path):
+    assert ia.read_shard(tmp_path) is None
+
+
+def test_sample_inputs_prefer_composite(tmp_path):
+    """A composite replaces the per-frequency echograms of its sample."""
+    out = tmp_path / "out"
+    for name in ("38000", "120000"):
+        Image.new("L", (8, 8)).save(tmp_path / f"{name}.png")
+    assert len(ia.sample_inputs(tmp_path, out)) == 2
+
+    Image.new("RGB", (8, 8)).save(tmp_path / "composite.png")
+    assert ia.sample_inputs(tmp_path, out) == [
+        (tmp_path / "composite.png", out / "composite.png")
+    ]
+
+    np.save(tmp_path / "tensors.npy", np.zeros((1, 8, 8, 3), dtype=np.uint8))
+    (tmp_path / "index.json").write_text(
+        json.dumps({"shape": [1, 8, 8, 3], "entries": [{"name": "composite"}]})
+    )
+    [((tensors, i), path)] = ia.sample_inputs(tmp_path, out)
+    assert (i, path) == (0, out / "composite.png")
+
+
+def test_cls_attention_matches_full_attention():
+    """The [CLS]-only path returns the first row of the full attention."""
+    import vision_transformer as vits
+
+    torch.manual_seed(0)
+    model = vits.vit_tiny(patch_size=16).eval()
+    img = torch.randn(2, 3, 64, 96)
+
+    with torch.no_grad():
+        full = model.get_last_selfattention(img)
+        cls = model.get_last_cls_attention(img)
+
+    assert cls.shape == (2, 3, 1, 1 + 4 * 6)
+    torch.testing.assert_close(cls, full[:, :, :1])
+
+
+def test_fused_attention_matches_explicit():
+    import vision_transformer as vits
+
+    torch.manual_seed(0)
+    attn = vits.Attention(dim=48, num_heads=3, qkv_bias=True).eval()
+    x = torch.randn(2, 17, 48)
+
+    with torch.no_grad():
+        expected, _ = attn(x)
+        torch.testing.assert_close(attn.forward_fused(x), expected)
+
+
+@pytest.mark.parametrize("chunk", [1, 5, 16, 100])
+def test_chunked_attention_matches_unchunked(chunk):
+    import vision_transformer as vits
+
+    torch.manual_seed(0)
+    model = vits.vit_tiny(patch_size=16).eval()
+    chunked = vits.vit_tiny(patch_size=16, attn_chunk=chunk).eval()
+    chunked.load_state_dict(model.state_dict())
+    img = torch.randn(2, 3, 64, 96)
+
+    with torch.no_grad():
+        torch.testing.assert_close(chunked(img), model(img))
+        torch.testing.assert_close(
+            chunked.get_last_cls_attention(img), model.get_last_cls_attention(img)
+        )
+
+
+def test_tile_starts_cover_length():
+    assert ia.tile_starts(100, 128, 32) == [0]
+    assert ia.tile_starts(128, 128, 32) == [0]
+    starts = ia.tile_starts(300, 128, 32)
+    assert starts == [0, 96, 172]
+    assert starts[-1] + 128 == 300
+
+
+def test_tiled_attention_blends_full_resolution():
+    import vision_transformer as vits
+
+    torch.manual_seed(0)
+    model = vits.vit_tiny(patch_size=16).eval()
+    img = torch.randn(3, 80, 112)
+
+    maps = ia.tiled_attention(model, img, 32, 8, 16, torch.device("cpu"))
+    assert maps.shape == (3, 80, 112)
+    assert maps.min() == 0 and maps.max() == pytest.approx(1)
+
+    # One tile covering the image is plain get_attention_maps
+    square = img[:, :64, :64]
+    with torch.no_grad():
+        expected = ia.get_attention_maps(model, square[None], (64, 64), 16)
+    np.testing.assert_allclose(
+        ia.tiled_attention(model, square, 64, 8, 16, torch.device("cpu")),
+        expected,
+        atol=1e-5,
+    )
+
+    # Raw attention is stitched and normalized once, not per tile
+    with torch.no_grad():
+        left, right = ia.get_attention_maps(
+            model,
+            torch.stack([img[:, :32, :32], img[:, :32, 32:64]]),
+            (32, 32),
+            16,
+            normalize=False,
+        )
+    raw = np.concatenate([left, right], axis=2)
+    np.testing.assert_allclose(
+        ia.tiled_attention(model, img[:, :32, :64], 32, 0, 16, torch.device("cpu")),
+        (raw - raw.min()) / (raw.max() - raw.min()),
+        atol=1e-5,
+    )
+
+    # Smaller than a tile: padded, then cropped back
+    small = ia.tiled_attention(model, img[:, :20, :40], 64, 8, 16, torch.device("cpu"))
+    assert small.shape == (3, 20, 40)
+
+    with pytest.raises(ValueError):
+        ia.tiled_attention(model, img, 40, 8, 16, torch.device("cpu"))
+
+
+def test_load_native_keeps_resolution(synthetic_png):
+    x = ia.load_native(synthetic_png)
+    assert x.shape == (3, *np.asarray(Image.open(synthetic_png)).shape[:2])
+    torch.testing.assert_close(x, ia.process_image(synthetic_png, x.shape[1:]))
+
+
+def test_bucket_size_keeps_aspect():
+    # Tall and narrow: the short side shrinks to one step instead of stretching
+    assert ia.bucket_size(5000, 100000, 5000, 8, 512) == (512, 5120)
+    assert ia.bucket_size(1000, 1000, 1000, 16, 100) == (1008, 1008)
+    h, w = ia.bucket_size(300, 500, 1000, 16, 64)
+    assert (h % 64, w % 64) == (0, 0)
+    assert abs(h / w - 300 / 500) < 0.1
+
+
+def test_plan_batches_groups_similar_sizes(tmp_path, monkeypatch):
+    monkeypatch.setattr(ia, "BATCH_SIZE", 2)
+    sizes = [(100, 400), (104, 396), (100, 400), (400, 100)]
+    paths = []
+    for i, (h, w) in enumerate(sizes):
+        paths.append(tmp_path / f"{i}.png")
+        Image.new("L", (w, h)).save(paths[-1])
+
+    batches = ia.plan_batches(paths, 256, 16, 64)
+    assert [(s, len(b)) for s, b in batches] == [
+        ((64, 256), 2),
+        ((64, 256), 1),
+        ((256, 64), 1),
+    ]
+
+    import vision_transformer as vits
+
+    model = vits.vit_tiny(patch_size=16).eval()
+    image_size, batch = batches[0]
+    x = ia.load_batch(batch, image_size, torch.device("cpu"))
+    assert x.shape == (2, 3, 64, 256)
+    with torch.no_grad():
+        maps = ia.get_attention_maps(model, x, image_size, 16)
+    assert maps[0].shape == (3, 64, 256)
+
+
+def test_pos_encoding_cache(monkeypatch):
+    import vision_transformer as vits
+
+    torch.manual_seed(0)
+    model = vits.vit_tiny(patch_size=16).eval()
+    calls = []
+    interpolate = model._interpolate_pos_encoding
+    monkeypatch.setattr(
+        model,
+        "_interpolate_pos_encoding",
+        lambda *a: calls.append(a) or interpolate(*a),
+    )
+    img = torch.randn(1, 3, 64, 96)
+
+    with torch.no_grad():
+        first = model(img)
+        torch.testing.assert_close(model(img), first)
+        assert len(calls) == 1
+
+        # Reloading weights drops interpolated encodings
+        state = model.state_dict()
+        state["pos_embed"] = torch.randn_like(state["pos_embed"])
+        model.load_state_dict(state)
+        model(img)
+        assert len(calls) == 2
+
+        # Bounded by bytes: the least recently used geometry is evicted.
+        # Entries hold 25, 5 and 10 tokens of 192 float32 values.
+        monkeypatch.setattr(model, "pos_cache_bytes", (25 + 10) * 192 * 4)
+        model(torch.randn(1, 3, 32, 32))
+        model(torch.randn(1, 3, 48, 48))
+        assert len(model._pos_cache) == 2
+        model(img)
+        assert len(calls) == 5
+
+        # Moving the model drops encodings cached for the old device / dtype
+        model.double()
+        assert not model._pos_cache
+        model.float()
+
+    # With gradients the encoding is recomputed, not served from the cache
+    model(img).sum().backward()
+    assert len(calls) == 6
+    assert model.pos_embed.grad is not None
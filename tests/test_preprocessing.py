@@ -1,3 +1,4 @@
+import json
 import os
 from unittest.mock import patch
 
@@ -154,8 +155,158 @@ def test_mask_computed_with_bottom_depth(synthetic_nc_with_bottom, tmp_path):
         assert mask_data.dtype == bool
 
 
+def test_channel_without_bottom_keeps_file(synthetic_nc_with_bottom, tmp_path):
+    """A channel with an all-NaN bottom is skipped; the other one still publishes."""
+    with xr.open_dataset(synthetic_nc_with_bottom) as ds:
+        ds = ds.load()
+    ds["bottom_depth"][1] = np.nan
+    nc_path = tmp_path / "test_nan_bottom.nc"
+    ds.to_netcdf(nc_path)
+
+    out = tmp_path / "output"
+    assert pp.sv_to_jpg(nc_path, out_dir=out)
+
+    assert sorted(p.name for p in (out / "test_nan_bottom").glob("*.png")) == [
+        "38000.png"
+    ]
+    assert not nc_path.with_suffix(".failed").exists()
+
+
+def test_bottom_smooth_blanks_below_seafloor(synthetic_nc, tmp_path):
+    """BOTTOM_SMOOTH masks and blanks everything below the smoothed bottom line."""
+    plain, smooth = tmp_path / "plain", tmp_path / "smooth"
+    assert pp.sv_to_jpg(synthetic_nc, estimate_bot=True, out_dir=plain)
+    with patch.object(pp, "bottom_smooth", 5):
+        assert pp.sv_to_jpg(synthetic_nc, estimate_bot=True, out_dir=smooth)
+
+    with np.load(smooth / ".bottom" / "test_sample" / "38000.npz") as cached:
+        bottom = cached["bottom"]
+    img = np.asarray(Image.open(smooth / "test_sample" / "38000.png"))
+    mask = np.load(smooth / "test_sample" / "38000_mask.npy").T
+    depth = np.linspace(0, 500, 100)
+    depth = depth[depth >= 25][: img.shape[0]]
+    seabed = depth[:, None] > bottom[None, :] + 3
+
+    assert seabed.any()
+    assert (img[seabed] == 0).all() and not mask[seabed].any()
+    before = np.asarray(Image.open(plain / "test_sample" / "38000.png"))
+    np.testing.assert_array_equal(img[~seabed], before[~seabed])
+
+
 def test_is_file_ready_nonexistent(tmp_path):
     """is_file_ready should return False for a non-existent file, not crash."""
     fake = tmp_path / "does_not_exist.nc"
     result = pp.is_file_ready(fake, retries=1, wait_time=0)
     assert result is False
+
+
+def test_sv_to_jpg_reads_zarr(synthetic_nc, tmp_path):
+    """Zarr stores from the conversion stage should be read like NetCDF files."""
+    zarr_path = tmp_path / "test_sample.zarr"
+    with xr.open_dataset(synthetic_nc) as ds:
+        ds.to_zarr(zarr_path)
+
+    out = tmp_path / "output"
+    out.mkdir()
+    with patch.object(pp, "output_dir", str(out)):
+        assert pp.sv_to_jpg(zarr_path, estimate_bot=True)
+
+    assert len(list((out / "test_sample").glob("*.png"))) == 2
+    assert zarr_path in pp.glob_inputs(tmp_path)
+
+
+def test_estimate_memory_uses_largest_channel(synthetic_nc):
+    """Memory estimates should come from per-channel metadata, not the whole cube."""
+    expected = int(pp.memory_factor * 8 * 50 * 100)
+    assert pp.estimate_memory(synthetic_nc) == expected
+    # Both channels in flight at once
+    assert pp.estimate_memory(synthetic_nc, workers=4) == 2 * expected
+
+
+def test_threaded_channels_match_serial(synthetic_nc, tmp_path):
+    """Rendering channels on a thread pool writes the same outputs."""
+    serial, threaded = tmp_path / "serial", tmp_path / "threaded"
+    with patch.object(pp, "bottom_cache", False):
+        assert pp.sv_to_jpg(synthetic_nc, estimate_bot=True, out_dir=serial)
+        assert pp.sv_to_jpg(
+            synthetic_nc, estimate_bot=True, out_dir=threaded, workers=2
+        )
+
+    names = sorted(p.name for p in (serial / "test_sample").iterdir())
+    assert names == sorted(p.name for p in (threaded / "test_sample").iterdir())
+    for name in names:
+        a = (serial / "test_sample" / name).read_bytes()
+        assert a == (threaded / "test_sample" / name).read_bytes()
+
+
+def test_threaded_seafloor_failure_cleans_up(synthetic_nc, tmp_path):
+    """A channel without seafloor fails the file once every thread is done."""
+    with patch.object(pp, "process_seafloor", side_effect=ValueError("no bottom")):
+        assert not pp.sv_to_jpg(
+            synthetic_nc, estimate_bot=True, out_dir=tmp_path, workers=2
+        )
+
+    assert synthetic_nc.with_suffix(".failed").exists()
+    assert not (tmp_path / "test_sample").exists()
+    assert not (tmp_path / ".tmp" / "test_sample").exists()
+
+
+def test_outputs_published_without_staging_leftovers(synthetic_nc, tmp_path):
+    """Echograms are staged under .tmp and moved into place in one rename."""
+    out = tmp_path / "output"
+    out.mkdir()
+
+    with patch.object(pp, "output_dir", str(out)):
+        assert pp.sv_to_jpg(synthetic_nc, estimate_bot=True)
+
+    assert (out / "test_sample" / "38000.png").exists()
+    assert not any((out / ".tmp").iterdir())
+
+
+def test_require_sidecar(tmp_path):
+    """With REQUIRE_SIDECAR, inputs are only picked up once <stem>.ready exists."""
+    inp = tmp_path / "input"
+    out = tmp_path / "output"
+    inp.mkdir()
+    out.mkdir()
+    (inp / "file1.nc").touch()
+    (inp / "file2.nc").touch()
+    (inp / "file2.ready").touch()
+
+    with patch.object(pp, "require_sidecar", True):
+        stems = {f.stem for f in pp.reduce_files_to_diff(inp, out)}
+
+    assert stems == {"file2"}
+
+
+def test_colormap_writes_rgb(synthetic_nc, tmp_path):
+    """With COLORMAP set, echograms are expanded to RGB through a LUT."""
+    out = tmp_path / "output"
+    out.mkdir()
+
+    with patch.object(pp, "output_dir", str(out)), patch.object(
+        pp, "colormap", "viridis"
+    ):
+        assert pp.sv_to_jpg(synthetic_nc, estimate_bot=True)
+
+    img = Image.open(out / "test_sample" / "38000.png")
+    assert img.mode == "RGB"
+
+
+def test_tensor_shard_output(synthetic_nc, tmp_path):
+    """OUTPUT_FORMAT=both writes resized uint8 tensors matching the PNGs."""
+    out = tmp_path / "output"
+
+    with patch.object(pp, "output_dir", str(out)), patch.object(
+        pp, "write_tensors", True
+    ), patch.object(pp, "tensor_size", 64):
+        assert pp.sv_to_jpg(synthetic_nc, estimate_bot=True)
+
+    sample = out / "test_sample"
+    index = json.loads((sample / "index.json").read_text())
+    tensors = np.load(sample / "tensors.npy")
+    assert tensors.shape == (2, 64, 64, 1) == tuple(index["shape"])
+    assert [e["name"] for e in index["entries"]] == ["38000", "70000"]
+
+    png = Image.open(sample / "38000.png").resize((64, 64), Image.BILINEAR)
+    np.testing.assert_array_equal(tensors[0, ..., 0], np.asarray(png))
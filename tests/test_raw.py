@@ -18,6 +18,7 @@ sys.modules["echolab2.instruments.EK80"] = _echolab_mock.instruments.EK80
 sys.modules["echolab2.instruments.EK60"] = _echolab_mock.instruments.EK60
 
 import raw as raw_module  # noqa: E402
+import scanner  # noqa: E402
 
 
 class MockSv:
@@ -72,6 +73,9 @@ def test_reduce_files_to_diff(tmp_path):
     (out / "file1.nc").touch()
     # file2 already has .processed marker
     (out / "file2.processed").touch()
+    # file4 already has a .zarr store
+    (inp / "file4.raw").touch()
+    (out / "file4.zarr").mkdir()
 
     result = list(raw_module.reduce_files_to_diff(inp, out))
     stems = {f.stem for f in result}
@@ -79,3 +83,369 @@ def test_reduce_files_to_diff(tmp_path):
     assert "file3" in stems
     assert "file1" not in stems
     assert "file2" not in stems
+    assert "file4" not in stems
+
+
+class MockChannel:
+    """Mock echolab raw_data object holding a slice of pings."""
+
+    def __init__(self, sv):
+        self.sv = sv
+
+    def get_sv(self, return_depth=True):
+        return self.sv
+
+    def get_bottom(self, return_depth=True):
+        return None
+
+
+def make_mock_read_raw(n_pings, n_depths=20, frequencies=(38000.0, 70000.0)):
+    """Return a read_raw replacement that serves ping ranges of a fake file.
+
+    `n_depths` may be a dict giving each frequency its own range grid.
+    """
+    rng = np.random.default_rng(0)
+    ping_time = np.datetime64("2024-01-01", "ms") + np.arange(n_pings) * np.timedelta64(
+        1, "s"
+    )
+    if not isinstance(n_depths, dict):
+        n_depths = {f: n_depths for f in frequencies}
+    depth = {f: np.linspace(0, 5 * n_depths[f], n_depths[f]) for f in frequencies}
+    data = {
+        f: rng.uniform(1e-8, 1e-3, size=(n_pings, n_depths[f])) for f in frequencies
+    }
+
+    def read_raw(fp, start_ping=None, end_ping=None, byte_range=None):
+        lo = 0 if start_ping is None else start_ping - 1
+        hi = n_pings if end_ping is None else min(end_ping, n_pings)
+        channels = {}
+        for f in frequencies:
+            if lo >= hi:
+                channels[f] = []
+                continue
+            sv = MockSv(f, ping_time[lo:hi], depth[f], data[f][lo:hi])
+            channels[f] = [MockChannel(sv)]
+        return None, channels
+
+    return read_raw
+
+
+def test_streaming_matches_full_read(tmp_path, monkeypatch):
+    """Windowed conversion should write the same Sv cube as a full read."""
+    monkeypatch.setattr(raw_module, "read_raw", make_mock_read_raw(n_pings=23))
+    out_path = tmp_path / "stream.nc"
+
+    raw_module.write_streaming(tmp_path / "fake.raw", out_path, window=5)
+
+    full = raw_module.generate_freq_sv_ds(tmp_path / "fake.raw")
+    with xr.open_dataset(out_path) as streamed:
+        assert streamed.Sv.shape == full.Sv.shape
+        np.testing.assert_allclose(streamed.Sv.values, full.Sv.values)
+        np.testing.assert_array_equal(
+            streamed.ping_time.values, full.ping_time.values.astype("datetime64[ns]")
+        )
+
+
+def test_streaming_reads_windows_by_byte_range(tmp_path, monkeypatch):
+    """Scanned files are read window by window, never from the first ping."""
+    from .test_scanner import write_raw
+
+    fp = write_raw(tmp_path / "long.raw", n_pings=23)
+    read_raw = make_mock_read_raw(n_pings=23)
+    windows = []
+
+    def recording_read_raw(fp, start_ping=None, end_ping=None, byte_range=None):
+        with raw_module.window_file(fp, *byte_range) as window:
+            windows.append(scanner.scan_raw(window))
+        return read_raw(fp, start_ping=start_ping, end_ping=end_ping)
+
+    monkeypatch.setattr(raw_module, "read_raw", recording_read_raw)
+    stores = list(raw_module.iter_sv_windows(fp, window=10))
+
+    assert len(stores) == 3
+    # Every reader parses the header and its own pings only: 3 datagrams per
+    # ping, less the NME0 trailing the last ping
+    assert [w.n_pings for w in windows] == [10, 10, 3]
+    assert sum(w.n_datagrams for w in windows) == 3 + 23 * 3 - 1
+
+
+def test_streaming_reuses_planned_scan(tmp_path, monkeypatch):
+    """A worker handed the planner's scan does not walk the file's headers again."""
+    from .test_scanner import write_raw
+
+    fp = write_raw(tmp_path / "long.raw", n_pings=23)
+    scan = scanner.scan_raw(fp)
+    ranges = []
+
+    def recording_read_raw(fp, start_ping=None, end_ping=None, byte_range=None):
+        ranges.append(byte_range)
+        return make_mock_read_raw(n_pings=23)(fp, start_ping, end_ping)
+
+    def no_scan(fp):
+        raise AssertionError(f"{fp} scanned again")
+
+    monkeypatch.setattr(raw_module, "read_raw", recording_read_raw)
+    monkeypatch.setattr(raw_module, "scan_raw", no_scan)
+    raw_module.write_streaming(fp, tmp_path / "out.nc", window=10, scan=scan)
+
+    assert ranges == [raw_module.byte_range(scan, s, s + 9) for s in (1, 11, 21)]
+
+
+def test_write_output_zarr_is_chunked_and_compressed(tmp_path, monkeypatch):
+    """Zarr output should be chunked along ping_time/depth with a Blosc/Zstd codec."""
+    monkeypatch.setattr(raw_module, "read_raw", make_mock_read_raw(n_pings=30))
+    monkeypatch.setattr(raw_module, "chunk_pings", 8)
+    monkeypatch.setattr(raw_module, "chunk_depth", 16)
+    ds = raw_module.generate_freq_sv_ds(tmp_path / "fake.raw")
+
+    out_path = tmp_path / "fake.zarr"
+    raw_module.write_output({None: ds}, out_path)
+
+    with xr.open_dataset(out_path, engine="zarr") as stored:
+        encoding = stored.Sv.encoding
+        assert encoding["chunks"] == (1, 8, 16)
+        assert encoding["compressor"].cname == "zstd"
+        np.testing.assert_allclose(stored.Sv.values, ds.Sv.values)
+
+
+def test_streaming_zarr_appends_windows(tmp_path, monkeypatch):
+    """Streaming mode should append windows to a Zarr store along ping_time."""
+    monkeypatch.setattr(raw_module, "read_raw", make_mock_read_raw(n_pings=17))
+    out_path = tmp_path / "stream.zarr"
+
+    raw_module.write_streaming(tmp_path / "fake.raw", out_path, window=4)
+
+    with xr.open_dataset(out_path, engine="zarr") as stored:
+        assert stored.sizes["ping_time"] == 17
+
+
+def test_parallel_channel_calibration_matches_serial(tmp_path, monkeypatch):
+    """Calibrating channels on a thread pool should merge to the same dataset."""
+    monkeypatch.setattr(
+        raw_module,
+        "read_raw",
+        make_mock_read_raw(n_pings=12, frequencies=(18000.0, 38000.0, 120000.0)),
+    )
+
+    serial = raw_module.generate_freq_sv_ds(tmp_path / "fake.raw", workers=1)
+    parallel = raw_module.generate_freq_sv_ds(tmp_path / "fake.raw", workers=3)
+
+    xr.testing.assert_identical(serial, parallel)
+
+
+def test_ragged_layout_keeps_native_grids(tmp_path, monkeypatch):
+    """Ragged output should store each channel on its own depth grid, unpadded."""
+    import preprocessing as pp
+
+    n_depths = {38000.0: 30, 200000.0: 12}
+    monkeypatch.setattr(
+        raw_module,
+        "read_raw",
+        make_mock_read_raw(n_pings=9, n_depths=n_depths, frequencies=tuple(n_depths)),
+    )
+    monkeypatch.setattr(raw_module, "sv_layout", "ragged")
+
+    for suffix in (".nc", ".zarr"):
+        out_path = (tmp_path / "ragged").with_suffix(suffix)
+        store = raw_module.generate_sv_store(tmp_path / "fake.raw")
+        raw_module.write_output(store, out_path)
+
+        channels = {freq: sv for freq, sv, _ in pp.iter_channels(out_path)}
+        assert set(channels) == set(n_depths)
+        for freq, sv in channels.items():
+            assert sv.shape == (9, n_depths[freq])
+
+
+def test_sv_encoding_roundtrip(tmp_path, monkeypatch):
+    """float32 and dB-scaled int16 encodings should decode transparently."""
+    import preprocessing as pp
+
+    monkeypatch.setattr(raw_module, "read_raw", make_mock_read_raw(n_pings=15))
+    monkeypatch.setattr(raw_module, "sv_complevel", 4)
+    ds = raw_module.generate_freq_sv_ds(tmp_path / "fake.raw")
+    expected_db = 10 * np.log10(ds.Sv.sel(frequency=38000.0).values)
+
+    for encoding, dtype, atol in (
+        ("float32", np.float32, 1e-4),
+        ("int16", np.int16, 0.006),
+    ):
+        monkeypatch.setattr(raw_module, "sv_encoding", encoding)
+        for suffix in (".nc", ".zarr"):
+            out_path = (tmp_path / encoding).with_suffix(suffix)
+            raw_module.write_output({None: ds.copy(deep=True)}, out_path)
+
+            with xr.open_dataset(out_path, mask_and_scale=False) as stored:
+                assert stored.Sv.dtype == dtype
+
+            channels = {f: sv for f, sv, _ in pp.iter_channels(out_path)}
+            decoded = pp.to_db(channels[38000.0]).values
+            np.testing.assert_allclose(decoded, expected_db, atol=atol)
+
+
+def test_shard_ranges_cover_file():
+    assert raw_module.shard_ranges(23, 10) == [(1, 10), (11, 20), (21, 23)]
+    assert raw_module.shard_ranges(10, 10) == [(1, 10)]
+
+
+def test_sharded_conversion_matches_full_read(tmp_path, monkeypatch):
+    """Converting ping-range shards and merging the parts equals a full read."""
+    n_depths = {38000.0: 30, 200000.0: 12}
+    monkeypatch.setattr(
+        raw_module,
+        "read_raw",
+        make_mock_read_raw(n_pings=23, n_depths=n_depths, frequencies=tuple(n_depths)),
+    )
+    fp = tmp_path / "fake.raw"
+
+    for layout in ("dense", "ragged"):
+        monkeypatch.setattr(raw_module, "sv_layout", layout)
+        parts = []
+        for index, (start, end) in enumerate(raw_module.shard_ranges(23, 10)):
+            part = raw_module.part_path(tmp_path, fp, index)
+            raw_module.convert_shard(fp, part, start, end)
+            parts.append(part)
+
+        out_path = tmp_path / f"{layout}.nc"
+        raw_module.merge_parts(fp, parts, out_path)
+
+        assert not (tmp_path / ".parts" / "fake").exists()
+        merged = raw_module.read_store(out_path)
+        full = raw_module.generate_sv_store(fp)
+        for group, ds in full.items():
+            if "Sv" in ds:
+                np.testing.assert_allclose(merged[group].Sv.values, ds.Sv.values)
+
+
+def test_consume_dir_shards_large_files(tmp_path, monkeypatch):
+    """Files above SHARD_PINGS are split across workers and merged into one output."""
+    from .test_scanner import write_raw
+
+    inp = tmp_path / "input"
+    out = tmp_path / "output"
+    inp.mkdir()
+    out.mkdir()
+    write_raw(inp / "big.raw", n_pings=23)
+
+    monkeypatch.setattr(raw_module, "read_raw", make_mock_read_raw(n_pings=23))
+    monkeypatch.setattr(raw_module, "shard_pings", 10)
+    monkeypatch.setenv("MEMORY_BUDGET", "1G")
+
+    raw_module.consume_dir(inp, out, max_workers=2)
+
+    with xr.open_dataset(out / "big.nc") as ds:
+        assert ds.sizes["ping_time"] == 23
+    assert not (out / ".parts" / "big").exists()
+
+
+def test_consume_dir_failed_shard_marks_file(tmp_path, monkeypatch):
+    """A failing shard drops the finished parts and marks the file as failed."""
+    from .test_scanner import write_raw
+
+    inp = tmp_path / "input"
+    out = tmp_path / "output"
+    inp.mkdir()
+    out.mkdir()
+    write_raw(inp / "big.raw", n_pings=23)
+
+    read_raw = make_mock_read_raw(n_pings=23)
+
+    def flaky_read_raw(fp, start_ping=None, end_ping=None, byte_range=None):
+        if start_ping == 11:
+            raise OSError("truncated datagram")
+        return read_raw(fp, start_ping=start_ping, end_ping=end_ping)
+
+    monkeypatch.setattr(raw_module, "read_raw", flaky_read_raw)
+    monkeypatch.setattr(raw_module, "shard_pings", 10)
+    monkeypatch.setenv("MEMORY_BUDGET", "1G")
+
+    raw_module.consume_dir(inp, out, max_workers=2)
+
+    assert (out / "big.failed").exists()
+    assert not (out / "big.nc").exists()
+    assert not (out / ".parts" / "big").exists()
+    assert list(raw_module.reduce_files_to_diff(inp, out)) == []
+
+
+def test_consume_dir_settled_broken_files(tmp_path, monkeypatch):
+    """Truncated files keep their complete pings; corrupt ones are marked."""
+    import os
+
+    from .test_scanner import datagram, write_raw
+
+    inp = tmp_path / "input"
+    out = tmp_path / "output"
+    inp.mkdir()
+    out.mkdir()
+    good = write_raw(tmp_path / "good.raw").read_bytes()
+    (inp / "cut.raw").write_bytes(good[: len(good) - 120])
+    (inp / "corrupt.raw").write_bytes(good + datagram(b"NME0", trailer=3))
+    for fp in inp.iterdir():
+        os.utime(fp, (0, 0))
+
+    read_raw = make_mock_read_raw(n_pings=5)
+
+    def windowed_read_raw(fp, start_ping=None, end_ping=None, byte_range=None):
+        # Serve as many pings as the byte range holds
+        with raw_module.window_file(fp, *byte_range) as window:
+            n_pings = scanner.scan_raw(window).n_pings
+        return read_raw(fp, start_ping=1, end_ping=n_pings)
+
+    monkeypatch.setattr(raw_module, "read_raw", windowed_read_raw)
+    monkeypatch.setattr(raw_module, "settle_seconds", 60)
+    monkeypatch.setenv("MEMORY_BUDGET", "1G")
+
+    raw_module.consume_dir(inp, out, max_workers=2)
+
+    with xr.open_dataset(out / "cut.nc") as ds:
+        assert ds.sizes["ping_time"] == 4
+    assert (out / "corrupt.failed").exists()
+    assert list(raw_module.reduce_files_to_diff(inp, out)) == []
+
+
+def test_fused_pipeline_skips_intermediate(tmp_path, monkeypatch):
+    """Fused mode renders echograms from memory without writing the .nc file."""
+    inp = tmp_path / "input"
+    out = tmp_path / "output"
+    images = tmp_path / "images"
+    for d in (inp, out, images):
+        d.mkdir()
+    (inp / "fused.raw").touch()
+
+    monkeypatch.setattr(raw_module, "read_raw", make_mock_read_raw(n_pings=20))
+    monkeypatch.setattr(raw_module, "fuse_preprocessing", True)
+    monkeypatch.setattr(raw_module, "write_intermediate", False)
+    monkeypatch.setattr(raw_module, "image_dir", str(images))
+
+    raw_module.process_file(inp / "fused.raw", out)
+
+    assert not (out / "fused.nc").exists()
+    assert (out / "fused.processed").exists()
+    assert {p.name for p in (images / "fused").glob("*.png")} == {
+        "38000.png",
+        "70000.png",
+    }
+    assert list(raw_module.reduce_files_to_diff(inp, out)) == []
+
+
+def test_outputs_are_published_atomically(tmp_path, monkeypatch):
+    """Outputs appear under their final name only when complete, with a sidecar."""
+    (tmp_path / "pub.raw").touch()
+    monkeypatch.setattr(raw_module, "read_raw", make_mock_read_raw(n_pings=8))
+    monkeypatch.setattr(raw_module, "completion_sidecar", True)
+
+    def fail(store, path):
+        path.write_bytes(b"partial")
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(raw_module, "write_output", fail)
+    raw_module.process_file(tmp_path / "pub.raw", tmp_path)
+    assert not (tmp_path / "pub.nc").exists()
+    assert not any((tmp_path / ".tmp").iterdir())
+
+    monkeypatch.undo()
+    monkeypatch.setattr(raw_module, "read_raw", make_mock_read_raw(n_pings=8))
+    monkeypatch.setattr(raw_module, "completion_sidecar", True)
+    raw_module.process_file(tmp_path / "pub.raw", tmp_path)
+    assert (tmp_path / "pub.nc").exists()
+    assert (tmp_path / "pub.ready").exists()
+    assert not any((tmp_path / ".tmp").iterdir())
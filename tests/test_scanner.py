@@ -0,0 +1,135 @@
+"""Tests for raw_consumer/scanner.py using synthetic EK80 datagrams."""
+
+import os
+import struct
+import time
+
+import numpy as np
+
+import scanner
+
+
+def datagram(dg_type, body=b"", ticks=0, trailer=None):
+    """Frame a datagram the way EK80 writes it."""
+    payload = struct.pack("<4sLL", dg_type, ticks & 0xFFFFFFFF, ticks >> 32) + body
+    trailer = len(payload) if trailer is None else trailer
+    return struct.pack("<l", len(payload)) + payload + struct.pack("<l", trailer)
+
+
+def raw3(channel, count, ticks, data_type=0x1):
+    header = struct.pack("<128sH2sll", channel.encode(), data_type, b"\0\0", 0, count)
+    return datagram(b"RAW3", header + b"\0" * (2 * count), ticks=ticks)
+
+
+def write_raw(path, n_pings=5, channels=("WBT 1-1 ES38", "WBT 2-1 ES120")):
+    # One second per ping, counted in 100 ns NT ticks
+    parts = [datagram(b"XML0", b"<Configuration/>")]
+    for i in range(n_pings):
+        for channel in channels:
+            parts.append(raw3(channel, count=100, ticks=(10**7) * i))
+        parts.append(datagram(b"NME0", b"$GPGGA", ticks=(10**7) * i))
+    path.write_bytes(b"".join(parts))
+    return path
+
+
+def test_scan_counts_pings_and_time_span(tmp_path):
+    """Channels, ping counts and time span should come from the headers alone."""
+    result = scanner.scan_raw(write_raw(tmp_path / "a.raw", n_pings=5))
+
+    assert result.usable
+    assert result.channels == ["WBT 1-1 ES38", "WBT 2-1 ES120"]
+    assert result.n_pings == 5
+    assert result.samples == 5 * 2 * 100
+    assert result.end_time - result.start_time == np.timedelta64(4, "s")
+    assert result.estimated_bytes > 0
+
+
+def test_scan_flags_truncated_and_corrupt(tmp_path):
+    """A cut-off tail is truncated; a bad trailer length is corrupt."""
+    good = write_raw(tmp_path / "good.raw").read_bytes()
+
+    truncated = tmp_path / "truncated.raw"
+    truncated.write_bytes(good[:-10])
+    assert scanner.scan_raw(truncated).truncated
+
+    corrupt = tmp_path / "corrupt.raw"
+    corrupt.write_bytes(good + datagram(b"NME0", b"$GPGGA", trailer=3))
+    result = scanner.scan_raw(corrupt)
+    assert result.error is not None
+    assert not result.usable
+
+
+def test_truncated_scan_keeps_complete_pings(tmp_path):
+    """Pings cut short by truncation are dropped; the complete ones stay usable."""
+    good = write_raw(tmp_path / "good.raw").read_bytes()
+
+    # Only the NME0 after the last ping is cut: all 5 pings are complete
+    tail = tmp_path / "tail.raw"
+    tail.write_bytes(good[:-10])
+    assert scanner.scan_raw(tail).n_pings == 5
+
+    # Cut inside the last RAW3 datagram, ping 5 lost its second channel
+    cut = len(good) - len(datagram(b"NME0", b"$GPGGA")) - 100
+    mid_ping = tmp_path / "mid_ping.raw"
+    mid_ping.write_bytes(good[:cut])
+    result = scanner.scan_raw(mid_ping)
+    assert result.truncated and result.usable
+    assert result.n_pings == 4
+    assert result.ping_ends[-1] == scanner.scan_raw(tail).ping_ends[3]
+
+
+def test_plan_work_waits_for_settled_files(tmp_path):
+    """Recently modified broken files are deferred; settled ones planned or rejected."""
+    good = write_raw(tmp_path / "good.raw").read_bytes()
+    truncated = tmp_path / "truncated.raw"
+    truncated.write_bytes(good[:-10])
+    corrupt = tmp_path / "corrupt.raw"
+    corrupt.write_bytes(good + datagram(b"NME0", b"$GPGGA", trailer=3))
+    rejected = []
+
+    def reject(fp, reason):
+        rejected.append(fp)
+
+    assert scanner.plan_work([truncated, corrupt], settle=60, reject=reject) == []
+    assert rejected == []
+
+    old = time.time() - 120
+    for fp in (truncated, corrupt):
+        os.utime(fp, (old, old))
+    plan = scanner.plan_work([truncated, corrupt], settle=60, reject=reject)
+    assert [(fp, scan.n_pings) for fp, scan in plan] == [(truncated, 5)]
+    assert rejected == [corrupt]
+
+
+def test_plan_work_skips_unusable_and_orders_largest_first(tmp_path):
+    small = write_raw(tmp_path / "small.raw", n_pings=2)
+    large = write_raw(tmp_path / "large.raw", n_pings=20)
+    empty = tmp_path / "empty.raw"
+    empty.write_bytes(datagram(b"XML0", b"<Configuration/>"))
+
+    plan = scanner.plan_work([small, empty, large])
+
+    assert [fp for fp, _ in plan] == [large, small]
+
+
+def test_ping_byte_ranges(tmp_path):
+    """Ping ranges map to the bytes of their datagrams, after the header."""
+    fp = write_raw(tmp_path / "a.raw", n_pings=5)
+    result = scanner.scan_raw(fp)
+    data = fp.read_bytes()
+
+    assert len(result.ping_ends) == result.n_pings == 5
+    assert data[: result.header_end] == datagram(b"XML0", b"<Configuration/>")
+    assert result.byte_range(6, 8) is None
+
+    # The window holds pings 3-4 only, preceded by the file header
+    first, end = result.byte_range(3, 4)
+    window = tmp_path / "window.raw"
+    window.write_bytes(data[: result.header_end] + data[first:end])
+    sliced = scanner.scan_raw(window)
+    assert sliced.usable and sliced.n_pings == 2
+    assert sliced.start_time - result.start_time == np.timedelta64(2, "s")
+
+    # Consecutive ranges tile the file after the header
+    assert result.byte_range(1, 2)[1] == result.byte_range(3, 5)[0]
+    assert result.byte_range(1, 99) == (result.header_end, result.ping_ends[-1])
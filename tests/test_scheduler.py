@@ -0,0 +1,89 @@
+"""Tests for the memory-aware scheduler shared by stages 1 and 2."""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import scheduler
+
+
+def test_parse_bytes():
+    assert scheduler.parse_bytes("4096") == 4096
+    assert scheduler.parse_bytes("512M") == 512 * 2**20
+    assert scheduler.parse_bytes("8GiB") == 8 * 2**30
+    assert scheduler.parse_bytes("1.5g") == int(1.5 * 2**30)
+
+
+def test_memory_budget_from_cgroup(tmp_path, monkeypatch):
+    """Without MEMORY_BUDGET the cgroup limit (v2, then v1) should be used."""
+    monkeypatch.delenv("MEMORY_BUDGET", raising=False)
+    monkeypatch.setenv("MEMORY_FRACTION", "0.5")
+
+    (tmp_path / "memory.max").write_text("1073741824\n")
+    assert scheduler.memory_budget(tmp_path) == 2**29
+
+    (tmp_path / "memory.max").write_text("max\n")
+    assert scheduler.cgroup_limit(tmp_path) is None
+
+    (tmp_path / "memory.max").unlink()
+    (tmp_path / "memory").mkdir()
+    (tmp_path / "memory" / "memory.limit_in_bytes").write_text("2147483648\n")
+    assert scheduler.memory_budget(tmp_path) == 2**30
+
+    monkeypatch.setenv("MEMORY_BUDGET", "3G")
+    assert scheduler.memory_budget(tmp_path) == 3 * 2**30
+
+
+@pytest.mark.parametrize("budget", [10, 25])
+def test_run_scheduled_respects_budget(budget):
+    """Running estimates never exceed the budget, and large items start first."""
+    costs = {"a": 8, "b": 2, "c": 9, "d": 5, "e": 30}
+    lock = threading.Lock()
+    state = {"in_use": 0, "peak": 0}
+    started = []
+
+    def work(item):
+        with lock:
+            started.append(item)
+            state["in_use"] += min(costs[item], budget)
+            state["peak"] = max(state["peak"], state["in_use"])
+        time.sleep(0.02)
+        with lock:
+            state["in_use"] -= min(costs[item], budget)
+        return item
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        done = [
+            future.result()
+            for _, future in scheduler.run_scheduled(
+                costs, lambda item: executor.submit(work, item), costs.get, budget, 4
+            )
+        ]
+
+    assert sorted(done) == sorted(costs)
+    assert started[0] == "e"
+    assert state["peak"] <= budget
+
+
+def test_run_scheduled_follow_up_items():
+    """Items returned by follow_up run too, within the same budget."""
+    costs = {"a1": 4, "a2": 4, "a": 6}
+    follow = {"a1": [], "a2": ["a"], "a": []}
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        done = [
+            item
+            for item, _ in scheduler.run_scheduled(
+                ["a1", "a2"],
+                lambda item: executor.submit(lambda: item),
+                costs.get,
+                10,
+                2,
+                follow_up=lambda item, future: follow[item],
+            )
+        ]
+
+    assert sorted(done) == ["a", "a1", "a2"]
+    assert done[-1] == "a"
@@ -0,0 +1,140 @@
+import os
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+import xarray as xr
+
+os.environ.setdefault("LOG_DIR", ".")
+
+import preprocessing as pp
+import seafloor
+
+
+def make_echogram(n_pings=60, n_depths=200, seed=1):
+    """dB echogram with a sloping bottom and a few strong echoes far below it."""
+    rng = np.random.default_rng(seed)
+    depth = np.linspace(0, 500, n_depths)
+    sv = rng.uniform(-80, -30, size=(n_pings, n_depths))
+    bottom_index = 90 + np.arange(n_pings) // 6
+    sv[np.arange(n_pings), bottom_index] = -10
+    sv[::7, 180] = -5  # multiples, outside 1.15 x the median bottom
+    sv[4, 5] = 0  # surface noise above min_depth
+
+    ping_time = np.datetime64("2024-01-01", "ns") + np.arange(n_pings).astype(
+        "timedelta64[s]"
+    )
+    return xr.DataArray(
+        sv, coords={"ping_time": ping_time, "depth": depth}, dims=["ping_time", "depth"]
+    )
+
+
+def reference(ds, depth0=25):
+    """The xarray implementation process_seafloor used before."""
+    ds = ds.where(ds.depth >= depth0, drop=True)
+    bottom_median = ds.idxmax("depth").median()
+    ds = ds.where(ds.depth <= 1.15 * bottom_median, drop=True)
+    return ds, ds.idxmax("depth")
+
+
+def test_detect_bottom_matches_xarray():
+    ds = make_echogram()
+    expected_ds, expected_bottom = reference(ds)
+
+    bottom, max_depth, _ = seafloor.detect_bottom(ds.values, ds.depth.values)
+
+    np.testing.assert_array_equal(bottom, expected_bottom.values)
+    assert expected_ds.depth.values.max() <= max_depth
+
+
+def test_process_seafloor_crops_like_xarray():
+    ds = make_echogram()
+    expected_ds, expected_bottom = reference(ds.copy())
+
+    result, bottom = pp.process_seafloor(ds)
+
+    np.testing.assert_array_equal(result.values, expected_ds.values)
+    np.testing.assert_array_equal(bottom.values, expected_bottom.values)
+
+
+def test_detect_bottom_drops_nan_rows():
+    """NaN depth rows are found in the same pass and left out like dropna."""
+    ds = make_echogram()
+    sv = ds.values.copy()
+    sv[:, 190:] = np.nan  # padding below the deepest range
+    sv[3, 95] = np.nan  # a row with NaN in one ping only
+    sv[10, 95] = 0  # ... and the strongest echo of another ping
+    sv[20, 185] = np.nan  # a padding row holding the maximum of no ping
+
+    bottom, max_depth, bad = seafloor.detect_bottom(sv, ds.depth.values)
+
+    expected_bad = np.isnan(sv).any(axis=0)
+    np.testing.assert_array_equal(bad, expected_bad)
+    kept = ds.isel(depth=~expected_bad)
+    expected = seafloor.detect_bottom(kept.values, kept.depth.values)
+    np.testing.assert_array_equal(bottom, expected[0])
+    assert max_depth == expected[1]
+
+    with pytest.raises(seafloor.NoData):
+        seafloor.detect_bottom(np.full((4, 10), np.nan), np.arange(10.0))
+
+
+def test_detect_bottom_smoothing():
+    """A median filter removes single-ping jumps from the bottom line."""
+    ds = make_echogram()
+    sv = ds.values.copy()
+    sv[30, 100:] = -90
+    sv[30, 60] = -10  # one ping with a spurious, much shallower bottom
+
+    raw, _, _ = seafloor.detect_bottom(sv, ds.depth.values)
+    smoothed, _, _ = seafloor.detect_bottom(sv, ds.depth.values, smooth=5)
+
+    assert raw[30] < raw[29] - 50
+    assert smoothed[30] == pytest.approx(raw[29], abs=5)
+
+
+def test_detect_bottom_nothing_to_search():
+    ds = make_echogram()
+    with pytest.raises(ValueError):
+        seafloor.detect_bottom(ds.values, ds.depth.values, min_depth=1000)
+
+
+def test_bottom_cache_reused(tmp_path):
+    """A cached bottom line is reused for the same source and settings only."""
+    source = tmp_path / "file.nc"
+    source.touch()
+    path = tmp_path / ".bottom" / "file" / "38000.npz"
+    key = seafloor.cache_key(source, smooth=0)
+    ds = make_echogram()
+
+    _, bottom = pp.process_seafloor(ds.copy(), cache=(path, key))
+    assert path.exists()
+
+    with patch.object(seafloor, "detect_bottom", side_effect=AssertionError):
+        _, cached = pp.process_seafloor(ds.copy(), cache=(path, key))
+    np.testing.assert_array_equal(cached.values, bottom.values)
+
+    # NaN rows are cached with the line, so a hit drops them without a read
+    padded = ds.copy()
+    padded[:, 190:] = np.nan
+    cropped, _ = pp.process_seafloor(padded.copy(), cache=(path, key + "p"))
+    with patch.object(seafloor, "detect_bottom", side_effect=AssertionError):
+        hit, _ = pp.process_seafloor(padded.copy(), cache=(path, key + "p"))
+    np.testing.assert_array_equal(hit.depth.values, cropped.depth.values)
+
+    stale = seafloor.cache_key(source, smooth=5)
+    assert seafloor.load_bottom(path, stale, ds.shape) is None
+    assert seafloor.load_bottom(path, key, (ds.shape[0] + 1, ds.shape[1])) is None
+
+
+def test_sv_to_jpg_caches_bottom(synthetic_nc, tmp_path):
+    out = tmp_path / "output"
+    out.mkdir()
+
+    with patch.object(pp, "output_dir", str(out)):
+        assert pp.sv_to_jpg(synthetic_nc, estimate_bot=True)
+
+    assert sorted(p.name for p in (out / ".bottom" / "test_sample").iterdir()) == [
+        "38000.npz",
+        "70000.npz",
+    ]
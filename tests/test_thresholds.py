@@ -0,0 +1,78 @@
+import os
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+
+os.environ.setdefault("LOG_DIR", ".")
+
+import preprocessing as pp
+import thresholds
+
+
+def make_data(shape=(300, 70), seed=3):
+    rng = np.random.default_rng(seed)
+    data = rng.normal(-60, 8, size=shape)
+    data[rng.random(shape) < 0.1] = np.nan
+    data[5, :] = np.nan
+    data[17, 3] = 40  # outlier
+    return data
+
+
+@pytest.mark.parametrize("block", [1, 64, 1000, 1 << 20])
+def test_nan_stats_matches_numpy(block):
+    data = make_data()
+    n, mean, var = thresholds.nan_stats(data, block=block)
+
+    assert n == np.count_nonzero(~np.isnan(data))
+    assert mean == pytest.approx(np.nanmean(data), rel=1e-12)
+    assert var == pytest.approx(np.nanvar(data), rel=1e-10)
+
+
+def test_nan_stats_all_nan():
+    n, mean, var = thresholds.nan_stats(np.full((4, 4), np.nan))
+    assert n == 0 and np.isnan(mean) and np.isnan(var)
+
+
+@pytest.mark.parametrize("block", [70, 1 << 20])
+def test_upper_mask_matches_reference(block):
+    """Same mask as comparing against nanmean + 3 * nanstd; NaN is False."""
+    data = make_data()
+    expected = data <= np.nanmean(data) + 3 * np.nanstd(data)
+
+    mask = thresholds.upper_mask(data, block=block)
+
+    np.testing.assert_array_equal(mask, expected)
+    assert not mask[17, 3] and not mask[5].any()
+
+
+def test_packed_mask_roundtrip(tmp_path):
+    data = make_data(shape=(40, 13))  # last axis not a multiple of 8
+    mask = thresholds.upper_mask(data)
+    bits = thresholds.upper_mask(data, packed=True, block=100)
+    assert bits.shape == (40, 2) and bits.dtype == np.uint8
+
+    thresholds.save_mask(tmp_path / "mask.npz", bits, data.shape)
+    thresholds.save_mask(tmp_path / "mask.npy", mask)
+
+    np.testing.assert_array_equal(thresholds.load_mask(tmp_path / "mask.npz"), mask)
+    np.testing.assert_array_equal(thresholds.load_mask(tmp_path / "mask.npy"), mask)
+
+
+@pytest.mark.parametrize("fixture", ["synthetic_nc", "synthetic_nc_with_bottom"])
+def test_sv_to_jpg_packed_masks(fixture, request, tmp_path):
+    """MASK_FORMAT=packed writes the same masks as <freq>_mask.npz."""
+    nc = request.getfixturevalue(fixture)
+    plain, packed = tmp_path / "plain", tmp_path / "packed"
+
+    with patch.object(pp, "output_dir", str(plain)):
+        assert pp.sv_to_jpg(nc, estimate_bot=True)
+    with patch.object(pp, "output_dir", str(packed)), patch.object(
+        pp, "packed_masks", True
+    ):
+        assert pp.sv_to_jpg(nc, estimate_bot=True)
+
+    for npy in plain.rglob("*_mask.npy"):
+        npz = packed / npy.relative_to(plain).with_suffix(".npz")
+        np.testing.assert_array_equal(thresholds.load_mask(npz), np.load(npy))
+    assert list(plain.rglob("*_mask.npy"))